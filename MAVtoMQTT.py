@@ -3,10 +3,13 @@
 #
 
 import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pymavlink import mavutil
 import paho.mqtt.client as mqtt
 import time
-import os
+from publishPolicy import PublishPolicy
 
 # Configuration
 baud_rate = 57600
@@ -15,137 +18,297 @@ button_channel = 8  # RC8 corresponds to channel 8
 button_threshold = 1500  # Threshold for button press
 mqtt_topic = "status/init_sampling"  # Topic to publish to
 mav_error_topic = "status/mavError"  # Topic to publish MAVLink connection error status
+heartbeat_timeout = 5  # Seconds without an autopilot heartbeat before the connection counts as lost
+status_interval = 5  # Seconds between repeated status/mavError publishes
 
-# Find the correct device by searching for available ttyACM* devices
-def find_mavlink_device():
-    possible_devices = glob.glob('/dev/ttyACM*')
-    for device in possible_devices:
-        try:
-            master = mavutil.mavlink_connection(device, baud=baud_rate)
-            print(f"Checking {device} for heartbeat...")
-            master.wait_heartbeat(timeout=5)
-            print(f"Connected to MAVLink device at {device}")
-            return master
-        except Exception as e:
-            print(f"Device {device} is not a MAVLink device: {e}")
-    print("No valid MAVLink device found.")
-    return None
+# Device discovery
+mavlink_endpoints = []  # Extra endpoints to try, e.g. "udpin:0.0.0.0:14550" or "tcp:192.168.2.2:5760"
+# Serial ports besides /dev/ttyACM* that may carry MAVLink, e.g. a telemetry radio's /dev/serial/by-id/ link.
+# Other ports are never opened: probing changes the baud rate and takes bytes meant for other devices.
+mavlink_serial_devices = []
+# Ports of other devices, never probed even if they show up above (sonarToMQTT.DEVICE_PORT is the Ping1D)
+excluded_devices = ['/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_AB0JJR9I-if00-port0']
+last_device_file = os.path.expanduser('~/.arcmetis_mavlink_device')  # Last device that answered
+cached_device_timeout = 1.5  # Seconds to wait for a heartbeat from the last known device
+probe_timeout = 5  # Seconds to wait for a heartbeat from each other candidate (probed in parallel)
+search_retry_interval = 2  # Seconds between searches when no device answers
 
-# Attempt to locate and connect to the MAVLink device
-master = find_mavlink_device()
+# Publish policy per telemetry topic (see publishPolicy.py):
+#   max_rate [Hz] - limit, min_rate [Hz] - heartbeat when unchanged, deadband - smallest change worth publishing
+publish_policies = {
+    "platform/mode":            {"min_rate": 0.1},
+    "platform/arming_status":   {"min_rate": 0.1},
+    "platform/battery_voltage": {"max_rate": 0.2, "min_rate": 1 / 60, "deadband": 0.05},   # V
+    "platform/gps_latitude":    {"max_rate": 1, "min_rate": 0.1, "deadband": 0.000005},    # deg, ~0.5 m
+    "platform/gps_longitude":   {"max_rate": 1, "min_rate": 0.1, "deadband": 0.00001},     # deg, ~0.5 m at 65 N
+    "platform/gps_altitude":    {"max_rate": 0.5, "min_rate": 1 / 60, "deadband": 1.0},   # m
+    "platform/gps_speed":       {"max_rate": 1, "min_rate": 0.1, "deadband": 0.1},         # m/s
+    "platform/heading":         {"max_rate": 1, "min_rate": 0.1, "deadband": 2},           # deg
+}
+policy = PublishPolicy(publish_policies)
 
-# Create a connection to the MQTT broker
-client = mqtt.Client()
-client.connect(mqtt_broker)
+# Remember the last device that answered, so it can be tried first next time
+def load_last_device():
+    try:
+        with open(last_device_file, 'r') as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
 
-# Function to monitor MAVLink connection and publish status
-def monitor_mavlink_connection():
-    global master
+def save_last_device(device):
     try:
-        # Check if heartbeat can be received
-        master.wait_heartbeat(timeout=5)
-        client.publish(mav_error_topic, "0")  # Connection is OK
-    except Exception as e:
-        print(f"MAVLink connection lost: {e}")
-        client.publish(mav_error_topic, "1")  # Connection lost
-        master = find_mavlink_device()  # Attempt to reconnect
+        with open(last_device_file, 'w') as file:
+            file.write(device)
+    except OSError as e:
+        print(f"Could not save last MAVLink device: {e}")
 
-# Function to monitor button presses and publish MQTT messages
-def monitor_button_press():
-    global previous_state
+def is_excluded(device):
+    return os.path.realpath(device) in {os.path.realpath(path) for path in excluded_devices}
+
+# Candidate devices: configured network endpoints and serial ports, and ttyACM* devices
+def candidate_devices():
+    candidates = list(mavlink_endpoints)
+    seen = set()
+    for device in list(mavlink_serial_devices) + sorted(glob.glob('/dev/ttyACM*')):
+        real_path = os.path.realpath(device)
+        if real_path not in seen and not is_excluded(device):  # Only probe each port once
+            seen.add(real_path)
+            candidates.append(device)
+    return candidates
+
+# Open a device and wait for a heartbeat, returns the connection or None.
+# Gives up early when stop is set because another device has answered.
+def probe_device(device, timeout, stop=None):
     try:
-        rc_channels = master.recv_match(type='RC_CHANNELS', blocking=True)
-        if rc_channels:
-            button_value = getattr(rc_channels, f'chan{button_channel}_raw', 0)
-            current_state = 1 if button_value > button_threshold else 0
-            if current_state != previous_state:  # Only publish if the state changes
-                print(f"Button state changed to {current_state}. Publishing to {mqtt_topic}...")
-                client.publish(mqtt_topic, str(current_state))
-                previous_state = current_state
+        master = mavutil.mavlink_connection(device, baud=baud_rate)
     except Exception as e:
-        print(f"Error monitoring button press: {e}")
+        print(f"Could not open {device}: {e}")
+        return None
+    try:
+        deadline = time.monotonic() + timeout
+        while stop is None or not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"No heartbeat from {device}")
+                break
+            if master.wait_heartbeat(timeout=min(remaining, 0.2)) is not None:
+                return master
+    except Exception as e:
+        print(f"Device {device} is not a MAVLink device: {e}")
+    master.close()
+    return None
+
+def close_result(future):
+    master = None if future.cancelled() else future.result()
+    if master is not None:
+        master.close()
+
+# Find the MAVLink device: the last known device first, then all other candidates in parallel
+def find_mavlink_device():
+    last_device = load_last_device()
+    if last_device and not is_excluded(last_device):
+        master = probe_device(last_device, cached_device_timeout)
+        if master:
+            print(f"Connected to MAVLink device at {last_device} (last known device)")
+            return master
+
+    candidates = [device for device in candidate_devices() if device != last_device]
+    if not candidates:
+        print("No valid MAVLink device found.")
+        return None
+
+    # Use the first device that answers, without waiting for the probes of the other ones to time out
+    found = None
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {pool.submit(probe_device, device, probe_timeout, stop): device for device in candidates}
+    for future in as_completed(futures):
+        master = future.result()
+        if master is not None:
+            found = future
+            break
+    stop.set()
+    for future in futures:
+        if future is not found:
+            future.add_done_callback(close_result)  # Closes connections that answered too late
+    pool.shutdown(wait=False)
+
+    if found is None:
+        print("No valid MAVLink device found.")
+        return None
+    device, master = futures[found], found.result()
+    print(f"Connected to MAVLink device at {device}")
+    save_last_device(device)
+    return master
+
+class DeviceSearch(threading.Thread):
+    """Searches for the MAVLink device in the background until one is found."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.result = None
+        self.done = threading.Event()
 
-# Telemetry publishing functions
-def publish_mode(client):
-    mode = master.flightmode
-    print(f"Current mode: {mode}")
-    client.publish("platform/mode", mode)
+    def run(self):
+        while self.result is None:
+            self.result = find_mavlink_device()
+            if self.result is None:
+                time.sleep(search_retry_interval)
+        self.done.set()
 
-def publish_battery_voltage(client):
-    battery = master.recv_match(type='BATTERY_STATUS', blocking=True)
-    if battery and battery.voltages:
+# MQTT client, created (or passed in by master.py) in main()
+client = None
+
+# Publish a telemetry value if the publish policy lets it through
+def publish(topic, value):
+    if policy.should_publish(topic, value):
+        client.publish(topic, value)
+
+# Publish held back changes and heartbeats of unchanged values
+def publish_due():
+    for topic, value in policy.due():
+        client.publish(topic, value)
+
+# Message handlers, registered per MAVLink message type with @handles(...)
+message_handlers = {}
+
+def handles(message_type):
+    """Registers the decorated function as a handler for one MAVLink message type."""
+    def register(func):
+        message_handlers.setdefault(message_type, []).append(func)
+        return func
+    return register
+
+def dispatch(msg):
+    """Passes one received message to every handler registered for its type."""
+    for handler in message_handlers.get(msg.get_type(), ()):
+        try:
+            handler(msg)
+        except Exception as e:
+            print(f"Error handling {msg.get_type()}: {e}")
+
+# Telemetry handlers, each publishes as soon as its message arrives
+@handles('HEARTBEAT')
+def handle_heartbeat(heartbeat):
+    global last_heartbeat
+    if heartbeat.type == mavutil.mavlink.MAV_TYPE_GCS:
+        return  # Heartbeats from ground stations say nothing about the autopilot
+    last_heartbeat = time.time()
+
+    mode = mavutil.mode_string_v10(heartbeat)
+    publish("platform/mode", mode)
+
+    armed = heartbeat.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED
+    arming_status = "armed" if armed else "disarmed"
+    publish("platform/arming_status", arming_status)
+
+@handles('BATTERY_STATUS')
+def handle_battery_status(battery):
+    if battery.voltages:
         valid_voltages = [v for v in battery.voltages if v != 65535]
         if valid_voltages:
             voltage = valid_voltages[0] / 1000.0
-            print(f"Battery voltage: {voltage:.2f}V")
-            client.publish("platform/battery_voltage", voltage)
-
-def publish_gps_coordinates(client):
-    gps = master.recv_match(type='GPS_RAW_INT', blocking=True)
-    if gps:
-        latitude = gps.lat / 1e7
-        longitude = gps.lon / 1e7
-        altitude = gps.alt / 1e3
-        print(f"GPS: Lat={latitude}, Lon={longitude}, Alt={altitude}m")
-        client.publish("platform/gps_latitude", latitude)
-        client.publish("platform/gps_longitude", longitude)
-        client.publish("platform/gps_altitude", altitude)
-
-def publish_arming_status(client):
-    heartbeat = master.recv_match(type='HEARTBEAT', blocking=True)
-    if heartbeat:
-        armed = heartbeat.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED
-        arming_status = "armed" if armed else "disarmed"
-        print(f"Arming status: {arming_status}")
-        client.publish("platform/arming_status", arming_status)
-
-def publish_gps_speed(client):
-    gps = master.recv_match(type='GPS_RAW_INT', blocking=True)
-    if gps:
-        gps_speed = gps.vel / 100.0
-        print(f"GPS speed: {gps_speed} m/s")
-        client.publish("platform/gps_speed", gps_speed)
-
-def publish_heading(client):
-    vfr_hud = master.recv_match(type='VFR_HUD', blocking=True)
-    if vfr_hud:
-        heading = vfr_hud.heading
-        print(f"Heading: {heading}°")
-        client.publish("platform/heading", heading)
-
-# Dictionary of telemetry functions
-telemetry_functions = {
-    "mode": publish_mode,
-    "battery_voltage": publish_battery_voltage,
-    "gps_coordinates": publish_gps_coordinates,
-    "arming_status": publish_arming_status,
-    "gps_speed": publish_gps_speed,
-    "heading": publish_heading,
-}
+            publish("platform/battery_voltage", voltage)
 
-# Main loop
-try:
-    previous_state = None  # Track the previous button state
-    while True:
-        # Monitor MAVLink connection
-        monitor_mavlink_connection()
+@handles('GPS_RAW_INT')
+def handle_gps_raw_int(gps):
+    latitude = gps.lat / 1e7
+    longitude = gps.lon / 1e7
+    altitude = gps.alt / 1e3
+    gps_speed = gps.vel / 100.0
+    publish("platform/gps_latitude", latitude)
+    publish("platform/gps_longitude", longitude)
+    publish("platform/gps_altitude", altitude)
+    publish("platform/gps_speed", gps_speed)
 
-        # Monitor button presses
-        if master:
-            monitor_button_press()
+@handles('VFR_HUD')
+def handle_vfr_hud(vfr_hud):
+    publish("platform/heading", vfr_hud.heading)
 
-        # Publish telemetry
-        for name, func in telemetry_functions.items():
-            print(f"Publishing {name}...")
-            func(client)
+# Button presses on the RC transmitter start/stop sampling
+@handles('RC_CHANNELS')
+def handle_rc_channels(rc_channels):
+    global previous_state
+    button_value = getattr(rc_channels, f'chan{button_channel}_raw', 0)
+    current_state = 1 if button_value > button_threshold else 0
+    if current_state != previous_state:  # Only publish if the state changes
+        print(f"Button state changed to {current_state}. Publishing to {mqtt_topic}...")
+        client.publish(mqtt_topic, str(current_state))
+        previous_state = current_state
 
-        # Sleep to limit execution frequency
-        time.sleep(0.5)
+# Publish the MAVLink connection status on change and every status_interval seconds
+def publish_mav_status(error):
+    global mav_error, last_status_publish
+    now = time.time()
+    if error != mav_error or now - last_status_publish >= status_interval:
+        if error and error != mav_error:
+            print("MAVLink connection lost.")
+        client.publish(mav_error_topic, "1" if error else "0")
+        mav_error = error
+        last_status_publish = now
 
-except KeyboardInterrupt:
-    print("Exiting...")
+# Main loop: read every incoming message once and dispatch it by type
+previous_state = None  # Track the previous button state
+last_heartbeat = time.time()
+mav_error = None
+last_status_publish = 0
 
-finally:
-    if master:
-        master.close()
-    client.disconnect()
+def main(shared_client=None, stop_event=None):
+    """Runs until interrupted, or until stop_event is set. master.py passes a shared client in single-process mode."""
+    global client, last_heartbeat
+    stop_event = stop_event or threading.Event()
+
+    # Create a connection to the MQTT broker
+    client = shared_client or mqtt.Client()
+    client.connect(mqtt_broker)
+    client.loop_start()
+
+    # The device is searched for in the background, also at startup, so MQTT keeps being served
+    master = None
+    search = DeviceSearch()
+    search.start()
+
+    try:
+        while not stop_event.is_set():
+            if master is None:
+                # No telemetry is republished without a connection, so the stale data watchdog in MQTTstatus
+                # sees the GPS topics stop. status/mavError flags the lost connection.
+                publish_mav_status(True)
+                if search.done.wait(0.2):
+                    master = search.result
+                    search = None
+                    last_heartbeat = time.time()
+                continue
+
+            try:
+                msg = master.recv_match(blocking=True, timeout=0.2)
+            except Exception as e:
+                print(f"Error reading from MAVLink device: {e}")
+                msg = None
+                last_heartbeat = 0  # Treat a read error like a lost connection
+
+            if msg is not None and msg.get_type() != 'BAD_DATA':
+                dispatch(msg)
+            publish_due()
+
+            # Monitor MAVLink connection
+            if time.time() - last_heartbeat > heartbeat_timeout:
+                publish_mav_status(True)
+                master.close()
+                master = None
+                search = DeviceSearch()  # Attempt to reconnect in the background
+                search.start()
+            else:
+                publish_mav_status(False)
+
+    except KeyboardInterrupt:
+        print("Exiting...")
+
+    finally:
+        if master:
+            master.close()
+        client.loop_stop()
+        client.disconnect()
+
+if __name__ == "__main__":
+    main()
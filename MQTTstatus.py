@@ -1,18 +1,59 @@
 #
-# This script handles any alarms from diffrent system and publishes to MQTT. 
+# This script handles any alarms from diffrent system and publishes to MQTT.
 #
+# status/alarms carries the code of the most severe active alarm (0 = no alarm), published as soon
+# as it changes and repeated every REPUBLISH_INTERVAL seconds while there is one. status/alarmSet
+# carries the whole active set as JSON. Alarms are acknowledged by publishing the code (or 0 for all)
+# on status/alarmAck.
+#
+# A watchdog also raises an alarm for every watched topic that has not been published for longer
+# than its timeout, so a script that died silently is noticed.
+#
+import json
 import paho.mqtt.client as mqtt
+import threading
 import time
+from alarmRegistry import AlarmConfig, AlarmRegistry
+from topicWatchdog import TopicWatchdog
 
 # MQTT setup
 BROKER_IP = "127.0.0.1"  # Adjust if needed
 STATUS_TOPIC = "status/alarms"
-ALERT_TOPICS = ["status/noUSB", 
-                "probe/leak",
-                "status/mavError",]
-TOPIC_ALERT_STATUS = {}  # Stores status numbers for each topic
-current_alerts = []
-alert_index = 0
+ALARM_SET_TOPIC = "status/alarmSet"
+ACK_TOPIC = "status/alarmAck"
+
+# Alarms per topic: a payload of 1 raises it, anything else clears it.
+# Codes are fixed so they mean the same after every restart. Severity 1 info, 2 warning, 3 critical.
+# Latching alarms stay active after they clear until they are acknowledged.
+ALARMS = [
+    AlarmConfig("status/noUSB", code=1, name="No USB drive", severity=2),
+    AlarmConfig("probe/leak", code=2, name="Probe leak", severity=3, latch=True),
+    AlarmConfig("status/mavError", code=3, name="No MAVLink connection", severity=2),
+]
+ALERT_TOPICS = [alarm.key for alarm in ALARMS]
+
+# Topic UDPtoMQTT publishes every probe packet on: "probe/tidGaaet", or "probe/frame" when its
+# PUBLISH_MODE is "frame"
+PROBE_TOPIC = "probe/tidGaaet"
+
+# Topics that must keep updating: topic -> (timeout [s], alarm code, alarm name, severity).
+# The timeout should be a few times the normal publish interval of the topic.
+WATCHED_TOPICS = {
+    PROBE_TOPIC:             (30, 10, "No probe data", 2),                # UDPtoMQTT, every probe packet
+    "status/udpStats":       (150, 11, "UDPtoMQTT not running", 2),       # Every 60 s
+    "platform/sonarDepth":   (10, 12, "No sonar data", 2),                # sonarToMQTT, several per second
+    "platform/gps_latitude": (30, 13, "No GPS data", 2),                  # MAVtoMQTT, at least every 10 s
+    "platform/winchState":   (20, 14, "No winch controller data", 2),     # winchController, every 5 s at rest
+}
+STALE_PREFIX = "stale:"  # Alarm key of a watched topic is STALE_PREFIX + topic
+
+REPUBLISH_INTERVAL = 1  # Seconds between repeats of the most severe alarm on status/alarms
+
+registry = AlarmRegistry(ALARMS + [
+    AlarmConfig(STALE_PREFIX + topic, code=code, name=name, severity=severity)
+    for topic, (timeout, code, name, severity) in WATCHED_TOPICS.items()
+])
+watchdog = TopicWatchdog({topic: timeout for topic, (timeout, code, name, severity) in WATCHED_TOPICS.items()})
 
 MAX_RETRIES = 5  # Maximum number of retries
 RETRY_INTERVAL = 5  # Time (in seconds) between retries
@@ -20,9 +61,10 @@ RETRY_INTERVAL = 5  # Time (in seconds) between retries
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected successfully to MQTT broker.")
-        for topic in ALERT_TOPICS:
+        for topic in ALERT_TOPICS + list(WATCHED_TOPICS) + [ACK_TOPIC]:
             client.subscribe(topic)
             print(f"Subscribed to {topic}")
+        publish_alarms(client)
     else:
         print(f"Failed to connect, return code {rc}")
 
@@ -43,6 +85,12 @@ def on_disconnect(client, userdata, rc):
 
 def on_message(client, userdata, msg):
     topic = msg.topic
+    if topic in WATCHED_TOPICS:
+        if watchdog.seen(topic) and registry.set_condition(STALE_PREFIX + topic, False):
+            print(f"Data on {topic} again")
+            publish_alarms(client)
+        return
+
     try:
         payload = round(float(msg.payload.decode()))
         print(f"Received message on {topic}: {payload}")
@@ -50,20 +98,29 @@ def on_message(client, userdata, msg):
         print(f"Received non-numeric payload: {msg.payload}")
         return
 
-    if payload == 1:
-        if topic not in TOPIC_ALERT_STATUS:
-            TOPIC_ALERT_STATUS[topic] = len(TOPIC_ALERT_STATUS) + 1
-        if topic not in current_alerts:
-            current_alerts.append(topic)
-            print(f"Alert added for topic {topic}, current alerts: {current_alerts}")
+    if topic == ACK_TOPIC:
+        changed = registry.acknowledge(payload or None)
+        print(f"Acknowledged {'all alarms' if not payload else f'alarm {payload}'}")
     else:
-        if topic in current_alerts:
-            current_alerts.remove(topic)
-            print(f"Alert removed for topic {topic}, current alerts: {current_alerts}")
+        changed = registry.set_condition(topic, payload == 1)
+        if changed:
+            print(f"Alarm for topic {topic} {'raised' if payload == 1 else 'cleared'}")
+
+    if changed:
+        publish_alarms(client)
 
-def main():
-    global alert_index
-    client = mqtt.Client()
+# Publish the most severe alarm and the whole active set, right away when something changed
+def publish_alarms(client):
+    code = registry.most_severe()
+    alarms = registry.snapshot()
+    print(f"Publishing alert status {code}, active alarms: {[alarm['code'] for alarm in alarms]}")
+    client.publish(STATUS_TOPIC, code)
+    client.publish(ALARM_SET_TOPIC, json.dumps(alarms, separators=(',', ':')), retain=True)
+
+def main(shared_client=None, stop_event=None):
+    """Runs until interrupted, or until stop_event is set. master.py passes a shared client in single-process mode."""
+    stop_event = stop_event or threading.Event()
+    client = shared_client or mqtt.Client()
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
@@ -76,23 +133,27 @@ def main():
 
     client.loop_start()
 
-    no_alerts_sent = False
-
+    # One timer for the watchdog and the repeats: sleep until whichever comes first
+    next_republish = time.monotonic() + REPUBLISH_INTERVAL
     while True:
-        if current_alerts:
-            no_alerts_sent = False
-            active_topic = current_alerts[alert_index % len(current_alerts)]
-            status = TOPIC_ALERT_STATUS[active_topic]
-            print(f"Publishing alert status {status} for topic {active_topic}")
-            client.publish(STATUS_TOPIC, status)
-            alert_index += 1
-        else:
-            if not no_alerts_sent:
-                print("Publishing no alert status (0)")
-                client.publish(STATUS_TOPIC, 0)
-                no_alerts_sent = True
-
-        time.sleep(1)
+        deadline = watchdog.next_deadline()
+        wake_at = next_republish if deadline is None else min(deadline, next_republish)
+        if stop_event.wait(max(0.0, wake_at - time.monotonic())):
+            break
+
+        changed = False
+        for topic in watchdog.check():
+            print(f"No data on {topic} for {watchdog.age(topic):.0f} s")
+            changed |= registry.set_condition(STALE_PREFIX + topic, True)
+        if changed:
+            publish_alarms(client)
+
+        # Repeat the most severe alarm for displays that joined late
+        if time.monotonic() >= next_republish:
+            next_republish += REPUBLISH_INTERVAL
+            code = registry.most_severe()
+            if code:
+                client.publish(STATUS_TOPIC, code)
 
 if __name__ == "__main__":
     main()
@@ -1,34 +1,42 @@
 #
 #Logs the data recived from MQTT to a file on a USB drive attached to raspberry pi (drive name must be ARCMETIS)
 #
-import csv
 import os
+import signal
+import threading
 import time
 from datetime import datetime
 import paho.mqtt.client as mqtt
+from probeSchema import load_schema
+from logWriter import CsvLogWriter, BinaryLogWriter
+from messageBus import message_json
 
 # Initialize variables for data and logging status
-data = {
-    "tidGaaet": None,
-    "P_ude": None,
-    "P_inde": None,
-    "RH": None,
-    "SCD30_temp": None,
-    "htu_temp": None,
-    "T_ude": None,
-    "CO2": None,
-    "O2": None,
-    "CH4": None,
-    "MIPEX": None,
-    "EC": None,
-    "Perc_bat": None,
-    "P_diff": None
-}
+# The columns come from the probe packet schema (see probe_schema.json)
+schema = load_schema()
+data = dict.fromkeys(schema.field_names())
 
 latitude = None
 longitude = None
 logging_enabled = False
-csv_file_path = None
+log_writer = None
+
+# Where probe rows come from:
+#   "frame"  - one probe/frame message per row (published by UDPtoMQTT in "frame" or "both" mode)
+#   "fields" - reassemble the per-field probe/* topics, probe/tidGaaet marks a row complete
+LOG_SOURCE = "frame"
+FRAME_TOPIC = "probe/frame"
+
+# Log file format:
+#   "csv"    - text CSV
+#   "binary" - compact fixed-width binary records, convert/slice to CSV with logExport.py
+LOG_FORMAT = "csv"
+
+# Log file buffering and rotation
+FLUSH_ROWS = 50                    # Write buffered rows to the USB drive every N rows
+FLUSH_INTERVAL = 10                # ...or every T seconds
+MAX_FILE_BYTES = 50 * 1024 * 1024  # Start a new log file at this size
+MAX_FILE_AGE = 24 * 3600           # ...or after this many seconds
 
 # USB base path and specific path for data logging
 usb_base_path = '/media/arcmetis/ARCMETIS/'
@@ -38,11 +46,19 @@ usb_present = os.path.exists(usb_base_path)
 usb_status_topic = "status/noUSB"
 gps_latitude_topic = "platform/gps_latitude"
 gps_longitude_topic = "platform/gps_longitude"
+station_done_topic = "status/stationDone"  # Published by coordinator when the winch leaves a station
 
 # Callback when a message is received
 def on_message(client, userdata, msg):
-    global logging_enabled, csv_file_path, latitude, longitude
+    global logging_enabled, log_writer, latitude, longitude
     topic = msg.topic
+
+    # One CSV row per frame message, parsed frames from the message bus are used as they are
+    if topic == FRAME_TOPIC:
+        if logging_enabled:
+            save_frame(msg)
+        return
+
     payload = msg.payload.decode()
 
     # Debug: print received topic and payload
@@ -57,16 +73,26 @@ def on_message(client, userdata, msg):
     # Start or stop logging based on "status/logging"
     elif topic == "status/logging":
         if payload in ["1", "1.0"] and not logging_enabled and usb_present:
-            logging_enabled = True
             # Create a new CSV file with UTC date and time in the name
-            current_time = datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S")
-            csv_file_path = os.path.join(usb_base_path, f"data_log_{current_time}.csv")
-            write_info_block()
-            print(f"Logging started. Data will be saved to {csv_file_path}")
+            try:
+                log_writer = open_log_writer()
+            except OSError as e:
+                print(f"Could not open a log file in {usb_base_path}: {e}")
+                client.publish(usb_status_topic, "1")
+                return
+            logging_enabled = True
+            print(f"Logging started. Data will be saved to {log_writer.path}")
         elif payload in ["0", "0.0"] and logging_enabled:
             logging_enabled = False
+            stop_logging()
             print("Logging stopped.")
 
+    # The winch is moving to the next station, a good time to force the log to the USB drive
+    elif topic == station_done_topic:
+        writer = log_writer
+        if writer is not None:
+            writer.sync()
+
     # Update data dictionary when probe topics are received
     elif logging_enabled and topic.startswith("probe/"):
         key = topic.split('/')[-1]
@@ -78,41 +104,59 @@ def on_message(client, userdata, msg):
             save_to_csv(data)
             reset_data()
 
-# Write the information block to the CSV file
-def write_info_block():
-    if csv_file_path is None:
-        print("CSV file path is not set.")
-        return
-
-    # Write the information block
-    with open(csv_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        writer.writerow(["Info Block"])
-        writer.writerow(["Time", current_time])
-        writer.writerow(["Data", "Logging started"])
-        writer.writerow(["Latitude", latitude if latitude else "Unknown"])
-        writer.writerow(["Longitude", longitude if longitude else "Unknown"])
-        writer.writerow([])  # Add a blank line for separation
-        print("Information block written to CSV.")
+# Information block written at the top of every log file
+def info_block_rows():
+    current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        ["Info Block"],
+        ["Time", current_time],
+        ["Data", "Logging started"],
+        ["Latitude", latitude if latitude else "Unknown"],
+        ["Longitude", longitude if longitude else "Unknown"],
+        [],  # Add a blank line for separation
+    ]
+
+# Create a new log file with UTC date and time in the name, in the configured format
+def open_log_writer():
+    options = dict(info_rows=info_block_rows, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL,
+                   max_bytes=MAX_FILE_BYTES, max_age=MAX_FILE_AGE)
+    fieldnames = list(data) + ["rx_time"]
+    if LOG_FORMAT == "binary":
+        return BinaryLogWriter(usb_base_path, fieldnames, formats=schema.storage_formats(),
+                               units=schema.units(), **options)
+    return CsvLogWriter(usb_base_path, fieldnames, **options)
 
 # Save data to CSV
 def save_to_csv(data):
-    if csv_file_path is None:
-        print("CSV file path is not set.")
+    writer = log_writer
+    if writer is None:
+        print("Log file is not open.")
+        return
+    writer.write(data)
+
+# Flush, fsync and close the log file
+def stop_logging():
+    global log_writer
+    writer = log_writer
+    log_writer = None
+    if writer is not None:
+        writer.close()
+
+# Close the log file cleanly when the service is stopped
+def handle_sigterm(signum, frame):
+    raise SystemExit("SIGTERM received")
+
+# Save a probe/frame message as one CSV row
+def save_frame(msg):
+    try:
+        frame = message_json(msg)
+    except ValueError:
+        print(f"Invalid frame message: {msg.payload}")
         return
 
-    # Append new row to the CSV file
-    with open(csv_file_path, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=data.keys())
-
-        # Write headers if file is empty
-        if file.tell() == 0:
-            writer.writeheader()
-
-        # Write the data as a row
-        writer.writerow(data)
-        print(f"Data saved: {data}")
+    row = {key: frame.get(key) for key in data}
+    row["rx_time"] = frame.get("rx_time")
+    save_to_csv(row)
 
 # Reset the data dictionary to 'None'
 def reset_data():
@@ -120,55 +164,59 @@ def reset_data():
     for key in data:
         data[key] = None
 
-# Setup MQTT client
-client = mqtt.Client()
-
-# Set up MQTT callbacks
-client.on_message = on_message
-
-# Connect to the MQTT broker (assumes broker is on the same Raspberry Pi)
-client.connect("127.0.0.1", keepalive=60)
-
-# USB fault handler: check for USB presence and publish status if absent
-if not usb_present:
-    client.publish(usb_status_topic, "1")
-    print(f"USB drive not found at {usb_base_path}. 'status/noUSB' set to 1.")
-else:
-    client.publish(usb_status_topic, "0")
-    print("USB drive is present.")
-
-# Subscribe to topics
-topics = [
-    "probe/tidGaaet",
-    "probe/P_ude",
-    "probe/P_inde",
-    "probe/RH",
-    "probe/SCD30_temp",
-    "probe/htu_temp",
-    "probe/T_ude",
-    "probe/CO2",
-    "probe/O2",
-    "probe/CH4",
-    "probe/MIPEX",
-    "probe/EC",
-    "probe/Perc_bat",
-    "probe/P_diff",
-    "status/logging",
-    "gps_latitude_topic",
-    "gps_longitude_topic"
-]
-
-for topic in topics:
-    client.subscribe(topic)
-
-# Loop to keep the script running and listening for MQTT messages
-client.loop_start()
-
-try:
-    # Keep the script running
-    while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    print("Script interrupted, exiting...")
-finally:
-    client.loop_stop()
+def main(shared_client=None, stop_event=None):
+    """Runs until interrupted, or until stop_event is set. master.py passes a shared client in single-process mode."""
+    stop_event = stop_event or threading.Event()
+
+    # Setup MQTT client
+    client = shared_client or mqtt.Client()
+
+    # Set up MQTT callbacks
+    client.on_message = on_message
+
+    # Connect to the MQTT broker (assumes broker is on the same Raspberry Pi)
+    client.connect("127.0.0.1", keepalive=60)
+
+    # USB fault handler: check for USB presence and publish status if absent
+    if not usb_present:
+        client.publish(usb_status_topic, "1")
+        print(f"USB drive not found at {usb_base_path}. 'status/noUSB' set to 1.")
+    else:
+        client.publish(usb_status_topic, "0")
+        print("USB drive is present.")
+
+    # Subscribe to topics
+    if LOG_SOURCE == "frame":
+        topics = [FRAME_TOPIC]
+    else:
+        topics = ["probe/" + key for key in data]
+
+    topics += [
+        "status/logging",
+        "gps_latitude_topic",
+        "gps_longitude_topic",
+        station_done_topic
+    ]
+
+    for topic in topics:
+        client.subscribe(topic)
+
+    # Loop to keep the script running and listening for MQTT messages
+    client.loop_start()
+    if shared_client is None:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+        # Keep the script running, flushing rows that have waited too long
+        while not stop_event.wait(1):
+            writer = log_writer
+            if writer is not None:
+                writer.tick()
+    except (KeyboardInterrupt, SystemExit):
+        print("Script interrupted, exiting...")
+    finally:
+        client.loop_stop()
+        stop_logging()
+
+if __name__ == "__main__":
+    main()
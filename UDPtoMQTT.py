@@ -1,90 +1,224 @@
 #this script takes in data from the probe over the UDP connection and sends it to the mqtt broker. 
 
+import asyncio
+import json
 import socket
+import threading
+from collections import deque
 import paho.mqtt.client as mqtt
 import time
+from messageBus import json_payload
+from probeSchema import load_schema, PacketError
 
-# Set up UDP server with socket timeout handling
-def udp_server(host='0.0.0.0', port=61557, buffer_size=1024, mqtt_broker='127.0.0.1'):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((host, port))
+# MQTT session settings
+RECONNECT_MIN_DELAY = 1       # First reconnect attempt after this many seconds
+RECONNECT_MAX_DELAY = 60      # Reconnect backoff doubles up to this many seconds
+OUTBOUND_QUEUE_SIZE = 10000   # Max publishes held in memory while the broker is down
 
-    # Set a timeout of 10 seconds to prevent the socket from hanging indefinitely
-    sock.settimeout(10)
-    
-    print(f"Listening for UDP packets on {host}:{port}...")
+# Publishing mode for probe packets:
+#   "fields" - one message per value on the probe/* topics
+#   "frame"  - the whole packet as one JSON message on FRAME_TOPIC
+#   "both"   - both of the above (dashboard uses the per-field topics)
+PUBLISH_MODE = "both"
+FRAME_TOPIC = "probe/frame"
+
+# Packet layouts, loaded and compiled once at startup (see probe_schema.json)
+schema = load_schema()
+
+# UDP receive settings
+QUEUE_SIZE = 1000                  # Datagrams waiting to be parsed, the oldest is dropped when full
+RECEIVE_BUFFER_SIZE = 1024 * 1024  # Kernel receive buffer (SO_RCVBUF) in bytes
+STATS_INTERVAL = 60                # Seconds between receive statistics reports
+STATS_TOPIC = "status/udpStats"
+VERBOSE = False                    # Print every packet (slow, for debugging only)
+
+class ProbePublisher:
+    """Long-lived MQTT session that buffers publishes while the broker is unreachable."""
+
+    def __init__(self, mqtt_broker, keepalive=60, queue_size=OUTBOUND_QUEUE_SIZE, client=None):
+        self.mqtt_broker = mqtt_broker
+        self.keepalive = keepalive
+        self.connected = False
+        self.dropped = 0  # Oldest queued publishes discarded because the queue was full
+        self.queue = deque(maxlen=queue_size)
+        self.lock = threading.Lock()
+
+        self.client = client or mqtt.Client()  # master.py passes a shared client in single-process mode
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY)
+
+    def start(self):
+        """Starts the background network loop, which also handles reconnects with backoff."""
+        self.client.connect_async(self.mqtt_broker, keepalive=self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Failed to connect to MQTT broker, return code {rc}")
+            return
+        print("Connected to MQTT broker.")
+        with self.lock:
+            self.connected = True
+            self.flush()
+
+    def on_disconnect(self, client, userdata, rc):
+        print(f"Disconnected from MQTT broker (rc={rc}), buffering until reconnected...")
+        with self.lock:
+            self.connected = False
+
+    def publish(self, topic, payload):
+        with self.lock:
+            # Keep ordering: only publish directly when nothing is waiting in the queue
+            if self.connected and not self.queue:
+                if self.client.publish(topic, payload).rc == mqtt.MQTT_ERR_SUCCESS:
+                    return
+                self.connected = False
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((topic, payload))
+
+    def flush(self):
+        """Sends queued publishes in order. Must be called with the lock held."""
+        if self.queue:
+            print(f"Flushing {len(self.queue)} buffered messages to MQTT broker.")
+        while self.queue and self.connected:
+            topic, payload = self.queue[0]
+            if self.client.publish(topic, payload).rc != mqtt.MQTT_ERR_SUCCESS:
+                self.connected = False
+                break
+            self.queue.popleft()
+
+class ProbeProtocol(asyncio.DatagramProtocol):
+    """Receive path for probe datagrams. Only timestamps and queues, parsing happens in process_queue()."""
+
+    def __init__(self, queue, stats):
+        self.queue = queue
+        self.stats = stats
+
+    def connection_made(self, transport):
+        # A larger kernel buffer absorbs bursts while the event loop is busy
+        sock = transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError as e:
+            print(f"Could not set UDP receive buffer size: {e}")
+
+    def datagram_received(self, data, addr):
+        self.stats["received"] += 1
+        if self.queue.full():
+            # Drop the oldest datagram so the newest probe data always gets through
+            self.queue.get_nowait()
+            self.stats["dropped"] += 1
+        self.queue.put_nowait((data, addr, time.time()))
+        self.stats["queue_high_water"] = max(self.stats["queue_high_water"], self.queue.qsize())
 
-    client = mqtt.Client()
+    def error_received(self, exc):
+        self.stats["socket_errors"] += 1
+        print(f"UDP socket error: {exc}")
 
+async def process_queue(queue, publisher, stats):
+    """Parses and publishes queued datagrams. A bad packet is counted and skipped."""
     while True:
+        data, addr, rx_time = await queue.get()
+        if VERBOSE:
+            print(f"Received message from {addr}: {data!r}")
         try:
-            data, addr = sock.recvfrom(buffer_size)
-            print(f"Received message from {addr}: {data.decode()}")
-            process_data(data.decode(), client, mqtt_broker)
+            ok = process_data(data.decode(), publisher, rx_time)
+        except Exception as e:  # process_data handles its own errors, this is a last resort
+            print(f"Error: {e}")
+            ok = False
+        if ok:
+            stats["processed"] += 1
+        else:
+            stats["bad"] += 1
 
-        except socket.timeout:
-            # Timeout reached, no packet received, continue listening
+async def report_stats(publisher, stats):
+    """Prints and publishes the receive counters every STATS_INTERVAL seconds."""
+    last_received = 0
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        if stats["received"] == last_received:
             print("No UDP packet received, waiting...")
-            continue  # Continue the loop and wait for the next packet
-        
-        except Exception as e:
-            print(f"Error: {e}")
-            time.sleep(5)  # Wait a bit before retrying in case of other errors
+        last_received = stats["received"]
+        report = dict(stats, mqtt_buffered=len(publisher.queue), mqtt_dropped=publisher.dropped)
+        print(f"UDP stats: {report}")
+        publisher.publish(STATS_TOPIC, json.dumps(report, separators=(',', ':')))
+
+async def serve(host='0.0.0.0', port=61557, mqtt_broker='127.0.0.1', queue_size=QUEUE_SIZE, client=None):
+    """Runs the UDP receiver, the processing worker and the stats reporter until cancelled."""
+    stats = {
+        "received": 0,          # Datagrams received from the socket
+        "processed": 0,         # Datagrams parsed and published
+        "bad": 0,               # Datagrams that could not be parsed
+        "dropped": 0,           # Datagrams dropped because the processing queue was full
+        "queue_high_water": 0,  # Largest processing queue depth seen
+        "socket_errors": 0,
+    }
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    # One MQTT session for the lifetime of the server
+    publisher = ProbePublisher(mqtt_broker, client=client)
+    publisher.start()
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: ProbeProtocol(queue, stats), local_addr=(host, port))
+    print(f"Listening for UDP packets on {host}:{port}...")
+
+    try:
+        await asyncio.gather(process_queue(queue, publisher, stats), report_stats(publisher, stats))
+    finally:
+        transport.close()
+        publisher.stop()
+
+def udp_server(host='0.0.0.0', port=61557, mqtt_broker='127.0.0.1'):
+    try:
+        asyncio.run(serve(host, port, mqtt_broker))
+    except KeyboardInterrupt:
+        print("Exiting...")
+
+def publish_packet(publisher, fields, rx_time):
+    """Publishes a parsed probe packet according to PUBLISH_MODE."""
+    if PUBLISH_MODE in ("frame", "both"):
+        frame = dict(fields, rx_time=round(rx_time, 3))
+        publisher.publish(FRAME_TOPIC, json_payload(publisher.client, frame))  # Not serialized for local subscribers
+
+    if PUBLISH_MODE in ("fields", "both"):
+        # tidGaaet goes last, MQTTtoLOG in "fields" mode uses it as the row complete marker
+        for key, value in fields.items():
+            if key != "tidGaaet":
+                publisher.publish(f"probe/{key}", value)
+        publisher.publish("probe/tidGaaet", fields["tidGaaet"])
+
+def process_data(data, publisher, rx_time=None):
+    """Parses one probe packet and publishes it. Returns False if the packet was not understood."""
+    if rx_time is None:
+        rx_time = time.time()
+    try:
+        layout, fields = schema.parse(data)
+    except PacketError as e:
+        print(f"{e}: {data!r}")
+        return False
 
-def process_data(data, client, mqtt_broker):
     try:
-        # Split the received data into parts and strip whitespace from each value
-        values = [value.strip() for value in data.split(',')]
-        
-        # Connect to the MQTT broker
-        client.connect(mqtt_broker)
-        
-        # Print the number of values for debugging
-        print(f"Number of values received: {len(values)}")
-        
-        if len(values) == 13:  # First packet format
-            tidGaaet, P_ude, P_inde, RH, SCD30_temp, htu_temp, T_ude, CO2, O2, CH4, MIPEX, EC, Perc_bat = values
-            P_diff = abs(float(P_ude) - float(P_inde))
-            
-            # Publish each value to its own MQTT topic
-            client.publish("probe/P_ude", P_ude)
-            client.publish("probe/P_inde", P_inde)
-            client.publish("probe/RH", RH)
-            client.publish("probe/SCD30_temp", SCD30_temp)
-            client.publish("probe/htu_temp", htu_temp)
-            client.publish("probe/T_ude", T_ude)
-            client.publish("probe/CO2", CO2)
-            client.publish("probe/O2", O2)
-            client.publish("probe/CH4", CH4)
-            client.publish("probe/MIPEX", MIPEX)
-            client.publish("probe/EC", EC)
-            client.publish("probe/Perc_bat", Perc_bat)
-            client.publish("probe/P_diff", P_diff)
-            client.publish("probe/tidGaaet", tidGaaet)
-
-            print(f"Published first packet values to respective topics.")
-        
-        elif len(values) == 3:  # Second packet format
-            tidGaaet, P_ude, Perc_bat = values
-            
-            # Publish to MQTT
-            client.publish("probe/P_ude", P_ude)
-            client.publish("probe/Perc_bat", Perc_bat)
-            client.publish("probe/tidGaaet", tidGaaet)
-            
-            print(f"Published second packet values to respective topics.")
-        
-        elif 'leak' in data:  # Leak message
-            # Convert leak message to boolean
-            leak_status = 1 if 'leak' in data else 0
-            client.publish("probe/leak", leak_status)
-            print(f"Published to probe/leak: {leak_status}")
-        
-        # Disconnect from the MQTT broker
-        client.disconnect()
+        if layout == "keyword":  # Keyword message like 'leak'
+            for topic, value in fields.items():
+                publisher.publish(topic, value)
+                print(f"Published to {topic}: {value}")
+        else:
+            publish_packet(publisher, fields, rx_time)
 
     except Exception as e:
-        print(f"Error processing data or publishing to MQTT: {e}")
+        print(f"Error publishing to MQTT: {e}")
+        return False
+
+    return True
 
 # Run the UDP server
-udp_server()
+if __name__ == "__main__":
+    udp_server()
@@ -0,0 +1,145 @@
+#
+# Adaptive sampling profile for the coordinator.
+#
+# Probe values are averaged over the dwell at each station (after a settling time). When a station
+# is finished its averages are compared with the nearest sampled stations above and below it:
+#   - a gradient above the threshold of any watched field inserts an extra station halfway between
+#     the two depths, as long as they are at least 2 * min_spacing apart, no station is planned
+#     between them yet and the time budget allows it
+#   - when every watched field changed by less than homogeneous_fraction of its threshold compared
+#     with the station above, the water column is considered homogeneous and the next station is
+#     sampled for min_dwell only
+#
+# Thresholds are in field units per metre, e.g. {"T_ude": 0.1} means 0.1 degC/m.
+#
+
+import time
+
+class StationAverage:
+    """Running mean of each watched field during one dwell."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value):
+        self.sums[name] = self.sums.get(name, 0.0) + value
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def means(self):
+        return {name: self.sums[name] / self.counts[name] for name in self.sums}
+
+class AdaptiveProfile:
+    """
+    Adapts the mission's list of (depth [m], time [min]) stations while it runs.
+    MissionEngine calls begin_mission(), start_dwell(), add_sample() and finish_station().
+    """
+
+    def __init__(self, thresholds, time_budget_min, min_dwell_min=2, min_spacing=1.0, settle_time=30,
+                 homogeneous_fraction=0.25, winch_speed=0.15, max_inserted=10, clock=time.monotonic):
+        self.thresholds = thresholds          # Field name -> gradient per metre that counts as a change
+        self.time_budget = time_budget_min * 60
+        self.min_dwell_min = min_dwell_min
+        self.min_spacing = min_spacing        # m, never insert stations closer together than this
+        self.settle_time = settle_time        # s after arrival before samples are used
+        self.homogeneous_fraction = homogeneous_fraction
+        self.winch_speed = winch_speed        # m/s, to estimate travel time for the budget
+        self.max_inserted = max_inserted
+        self.clock = clock
+        self.begin_mission()
+
+    def begin_mission(self):
+        self.mission_start = self.clock()
+        self.inserted = 0
+        self.sampled = {}         # Depth -> StationAverage of every finished station
+        self.current = None       # StationAverage of the station being sampled
+        self.dwell_start = None
+        self.homogeneous = False  # Result of the last comparison, shortens the next dwell
+
+    def dwell_min(self, programmed_min):
+        """Dwell to use for the station about to be sampled."""
+        if self.homogeneous:
+            return min(programmed_min, self.min_dwell_min)
+        return programmed_min
+
+    def start_dwell(self, depth):
+        self.current = StationAverage(depth)
+        self.dwell_start = self.clock()
+
+    def add_sample(self, fields):
+        """Probe values (dict of field name -> value) received while at a station."""
+        if self.current is None or self.clock() - self.dwell_start < self.settle_time:
+            return
+        for name in self.thresholds:
+            value = fields.get(name)
+            if isinstance(value, (int, float)):
+                self.current.add(name, value)
+
+    def finish_station(self, index, depths_and_times):
+        """Called when the dwell at depths_and_times[index] is over. Returns the (possibly changed) list."""
+        station, self.current = self.current, None
+        if station is None or not station.counts:
+            return depths_and_times
+        self.sampled[station.depth] = station
+
+        above = [depth for depth in self.sampled if depth < station.depth]
+        below = [depth for depth in self.sampled if depth > station.depth]
+        neighbours = []
+        if above:
+            neighbours.append(self.sampled[max(above)])
+        if below:
+            neighbours.append(self.sampled[min(below)])
+
+        changed = list(depths_and_times)
+        for number, neighbour in enumerate(neighbours):
+            spacing = abs(station.depth - neighbour.depth)
+            gradients = self.gradients(neighbour, station, spacing)
+            if not gradients:
+                continue
+            if number == 0 and neighbour.depth < station.depth:
+                self.homogeneous = all(gradient < self.homogeneous_fraction * self.thresholds[name]
+                                       for name, gradient in gradients.items())
+                if self.homogeneous:
+                    print(f"Homogeneous between {neighbour.depth} m and {station.depth} m, shortening the next dwell.")
+            steep = [name for name, gradient in gradients.items() if gradient >= self.thresholds[name]]
+            if steep:
+                self.insert_station(index, changed, neighbour.depth, station.depth, steep)
+        return changed
+
+    def insert_station(self, index, depths_and_times, depth_a, depth_b, steep):
+        """Inserts a station halfway between depth_a and depth_b right after index, if there is room and time."""
+        low, high = min(depth_a, depth_b), max(depth_a, depth_b)
+        if high - low < 2 * self.min_spacing or self.inserted >= self.max_inserted:
+            return
+        if any(low < depth < high for depth, _ in depths_and_times[index + 1:]):
+            return  # Already planned
+
+        depth = round((low + high) / 2, 2)
+        dwell = depths_and_times[index][1]
+        next_depth = depths_and_times[index + 1][0] if index + 1 < len(depths_and_times) else depths_and_times[index][0]
+        detour = abs(depth - depths_and_times[index][0]) + abs(next_depth - depth) \
+            - abs(next_depth - depths_and_times[index][0])
+        extra = dwell * 60 + detour / self.winch_speed
+        if self.estimated_end(index, depths_and_times) + extra > self.mission_start + self.time_budget:
+            print(f"Gradient in {', '.join(steep)} at {depth} m, no time left in the budget for an extra station.")
+            return
+
+        print(f"Gradient in {', '.join(steep)}, inserting a station at {depth} m for {dwell} min.")
+        self.inserted += 1
+        depths_and_times.insert(index + 1, (depth, dwell))
+
+    def gradients(self, previous, station, spacing):
+        previous_means = previous.means()
+        means = station.means()
+        return {name: abs(means[name] - previous_means[name]) / spacing
+                for name in means if name in previous_means}
+
+    def estimated_end(self, index, depths_and_times):
+        """Estimated time the mission ends with the remaining stations as programmed."""
+        remaining = 0.0
+        depth = depths_and_times[index][0]
+        for next_depth, time_in_min in depths_and_times[index + 1:]:
+            remaining += abs(next_depth - depth) / self.winch_speed + self.dwell_min(time_in_min) * 60
+            depth = next_depth
+        return self.clock() + remaining
@@ -0,0 +1,136 @@
+#
+# Alarm registry for MQTTstatus.
+#
+# Every alarm is configured with a fixed code, a severity and whether it latches, so the codes on
+# status/alarms mean the same thing after every restart. Active alarms are kept in a dict by code
+# and ordered by priority in a heap, so the most severe one is always known without a scan.
+#
+# Lifecycle of an alarm:
+#   condition on            -> active, unacknowledged
+#   acknowledge             -> stays active (acknowledged) while the condition is on
+#   condition off           -> cleared, unless it latches and has not been acknowledged yet
+#   acknowledge a latched   -> cleared once the condition is off
+#
+# Priority: unacknowledged before acknowledged, then higher severity, then the alarm raised first.
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+SEVERITY_NAMES = {1: "info", 2: "warning", 3: "critical"}
+
+class AlarmConfig:
+    __slots__ = ("key", "code", "name", "severity", "latch")
+
+    def __init__(self, key, code, name, severity=2, latch=False):
+        self.key = key            # What raises it, e.g. the MQTT topic
+        self.code = code          # Number published on status/alarms, never 0
+        self.name = name
+        self.severity = severity  # 1 info, 2 warning, 3 critical
+        self.latch = latch        # Stays active after the condition clears until acknowledged
+
+class ActiveAlarm:
+    __slots__ = ("config", "condition", "acknowledged", "since", "entry")
+
+    def __init__(self, config, since):
+        self.config = config
+        self.condition = True
+        self.acknowledged = False
+        self.since = since
+        self.entry = None  # Number of its current heap entry
+
+    def priority(self):
+        return (self.acknowledged, -self.config.severity, self.since)
+
+class AlarmRegistry:
+    """Thread-safe set of active alarms. Methods that change it return True when the active set changed."""
+
+    def __init__(self, configs, clock=time.time):
+        self.configs = {}
+        for config in configs:
+            if config.code == 0:
+                raise ValueError(f"Alarm {config.name}: code 0 means 'no alarm'")
+            if any(other.code == config.code for other in self.configs.values()):
+                raise ValueError(f"Alarm {config.name}: code {config.code} is used twice")
+            self.configs[config.key] = config
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.active = {}  # Code -> ActiveAlarm
+        self.heap = []    # (priority, entry, code); only the alarm's latest entry number is valid
+        self.entries = itertools.count()
+
+    def set_condition(self, key, on):
+        """Updates the condition behind the alarm configured for key."""
+        config = self.configs.get(key)
+        if config is None:
+            return False
+        with self.lock:
+            alarm = self.active.get(config.code)
+            if on:
+                if alarm is None:
+                    self.active[config.code] = alarm = ActiveAlarm(config, self.clock())
+                elif alarm.condition:
+                    return False
+                alarm.condition = True
+                self.push(alarm)
+                return True
+            if alarm is None or not alarm.condition:
+                return False
+            alarm.condition = False
+            if config.latch and not alarm.acknowledged:
+                self.push(alarm)  # Latched, still shown until acknowledged
+            else:
+                self.remove(alarm)
+            return True
+
+    def acknowledge(self, code=None):
+        """Acknowledges one alarm by code, or all active alarms when code is None."""
+        with self.lock:
+            alarms = list(self.active.values()) if code is None else [self.active.get(code)]
+            changed = False
+            for alarm in alarms:
+                if alarm is None or alarm.acknowledged:
+                    continue
+                alarm.acknowledged = True
+                changed = True
+                if alarm.condition:
+                    self.push(alarm)
+                else:
+                    self.remove(alarm)
+            return changed
+
+    def most_severe(self):
+        """Code of the highest priority active alarm, 0 when there is none."""
+        with self.lock:
+            while self.heap:
+                _, entry, code = self.heap[0]
+                alarm = self.active.get(code)
+                if alarm is not None and alarm.entry == entry:
+                    return code
+                heapq.heappop(self.heap)
+            return 0
+
+    def snapshot(self):
+        """Active alarms in priority order as a list of dicts."""
+        with self.lock:
+            alarms = sorted(self.active.values(), key=ActiveAlarm.priority)
+            return [{
+                "code": alarm.config.code,
+                "name": alarm.config.name,
+                "severity": SEVERITY_NAMES.get(alarm.config.severity, alarm.config.severity),
+                "active": alarm.condition,
+                "acked": alarm.acknowledged,
+                "since": round(alarm.since, 1),
+            } for alarm in alarms]
+
+    def push(self, alarm):
+        alarm.entry = next(self.entries)
+        heapq.heappush(self.heap, (alarm.priority(), alarm.entry, alarm.config.code))
+        if len(self.heap) > 4 * len(self.active) + 16:  # Mostly stale entries, rebuild
+            self.heap = [(a.priority(), a.entry, code) for code, a in self.active.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, alarm):
+        del self.active[alarm.config.code]  # Its heap entries are dropped when they reach the top
@@ -5,10 +5,14 @@
 # the script also controles the probe by sending UDP messages. 
 #
 
-import time
+import json
+import os
 import paho.mqtt.client as mqtt
-import threading
 import socket
+import threading
+from missionEngine import Scheduler, MissionEngine
+from adaptiveProfile import AdaptiveProfile
+from messageBus import message_json
 
 # USB base path
 usb_base_path = '/media/arcmetis/ARCMETIS/'
@@ -18,18 +22,34 @@ file_path = usb_base_path + file_name
 # MQTT Configuration
 broker_address = "127.0.0.1"
 setpoint_topic = "platform/winchSetPoint"
-sonar_depth_topic = "platform/sonarDepth"
+sonar_depth_topic = "platform/sonarDepthFiltered"  # Filtered sonar depth in m with a quality flag
 init_sampling_topic = "status/init_sampling"
+winch_state_topic = "platform/winchState"
+station_done_topic = "status/stationDone"
+probe_frame_topic = "probe/frame"
+
+# Mission progress, saved after every station so a restart resumes the profile
+progress_file = os.path.expanduser('~/.arcmetis_mission.json')
+ARRIVAL_TOLERANCE = 0.1  # m, the winch has reached a station within this of the setpoint
+ARRIVAL_TIMEOUT = 600    # s, start the dwell anyway if the winch does not report arrival
+PUBLISH_STATION_DONE = True  # Publish status/stationDone so MQTTtoLOG syncs the log while the winch moves
+
+# Adaptive profiling: add stations where the probe sees a gradient and shorten dwells where the
+# water column is homogeneous, within a total time budget (see adaptiveProfile.py).
+# Needs UDPtoMQTT to publish probe/frame (PUBLISH_MODE "frame" or "both").
+ADAPTIVE_PROFILE = False
+ADAPTIVE_THRESHOLDS = {"CH4": 0.2, "CO2": 10, "T_ude": 0.1, "EC": 0.01}  # Gradient per metre that counts as a change
+ADAPTIVE_TIME_BUDGET = 120  # min, whole mission including travel
+ADAPTIVE_MIN_DWELL = 2      # min, dwell where the water column is homogeneous
+ADAPTIVE_MIN_SPACING = 1.0  # m, closest spacing of inserted stations
 
 # UDP Server Configuration
 server_ip = '192.168.1.63'
 server_port = 61556
 
-# Global variables for state and sonar depth limit
-sonar_depth_limit = float('inf')  # Default to no limit
-state = "idle"  # Possible states: "idle", "sampling", "waiting"
-depths_and_times = []  # List to hold depths and times
-current_index = 0  # Index of the current depth-time pair
+# The mission engine and its scheduler, all mission changes run on the scheduler thread (set up in main())
+scheduler = None
+engine = None
 
 # UDP socket setup
 udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -44,44 +64,43 @@ def send_udp_message(message):
         print(f"Failed to send UDP message: {e}")
 
 
-# Callback for sonar depth updates
+# Callback for MQTT messages, hands them to the mission engine without waiting
 def on_message(client, userdata, message):
-    global sonar_depth_limit, state, current_index, depths_and_times
-
     if message.topic == sonar_depth_topic:
         try:
-            sonar_depth = float(message.payload.decode())
-            sonar_depth_limit = sonar_depth - 2  # Apply 2-meter safety buffer
-            print(f"Updated sonar depth limit: {sonar_depth_limit} meters")
-            if not depths_and_times:
-                generate_default_depths()  # Generate default depths based on updated limit
-        except ValueError:
+            sonar = message_json(message)
+            if sonar["quality"] == "good":  # Settling, held and invalid depths never move the depth limit
+                scheduler.post(engine.on_sonar_depth, float(sonar["depth"]))
+        except (ValueError, KeyError, TypeError):
             print("Invalid sonar depth value received")
     
     elif message.topic == init_sampling_topic:
         try:
             init_value = int(message.payload.decode())
-            if init_value == 1 and state != "sampling":
-                print("Switching to sampling state.")
-                state = "sampling"
-                current_index = 0  # Restart sampling from the first depth
-                send_udp_message("on")  # Notify server sampling has started
-            elif init_value == 0 and state != "idle":
-                print("Switching to idle state.")
-                state = "idle"
-                send_udp_message("stop")  # Notify server sampling has stopped
+            scheduler.post(engine.on_init_sampling, init_value)
         except ValueError:
             print("Invalid init sampling value received")
 
+    elif message.topic == winch_state_topic:
+        try:
+            winch = message_json(message)
+            scheduler.post(engine.on_winch_state, winch["state"], winch["pos"] / 100)  # cm to m
+        except (ValueError, KeyError, TypeError):
+            print("Invalid winch state received")
+
+    elif message.topic == probe_frame_topic:
+        try:
+            scheduler.post(engine.on_probe_sample, message_json(message))
+        except ValueError:
+            print("Invalid probe frame received")
 
-# Function to listen to MQTT topics
-def mqtt_listen():
-    client = mqtt.Client()
-    client.on_message = on_message
-    client.connect(broker_address)
-    client.subscribe([(sonar_depth_topic, 0), (init_sampling_topic, 0)])
+
+def on_connect(client, userdata, flags, rc):
+    topics = [(sonar_depth_topic, 0), (init_sampling_topic, 0), (winch_state_topic, 0)]
+    if ADAPTIVE_PROFILE:
+        topics.append((probe_frame_topic, 0))
+    client.subscribe(topics)
     print("Listening to MQTT topics...")
-    client.loop_forever()
 
 
 # Read depths and times from the file
@@ -101,82 +120,56 @@ def read_depths_and_times(file_path):
         return []
 
 
-# Generate default depths based on sonar depth limit
-def generate_default_depths():
-    global depths_and_times, sonar_depth_limit
-    if sonar_depth_limit == float('inf'):
-        print("Sonar depth limit not set. Cannot generate default depths.")
-        return
-
-    depths_and_times = []
-    depth = 0
-    while depth + 5 <= sonar_depth_limit:  # Increment by 5 meters
-        depths_and_times.append((depth, 10))  # Time is 10 minutes for each depth
-        depth += 5
-
-    print(f"Generated default depths up to {sonar_depth_limit - 2} meters with a 2-meter safety buffer:")
-    print(depths_and_times)
-
-
-# Publish depths in the sampling state
-def sampling_loop(client):
-    global state, current_index
-
-    while True:
-        if state == "sampling" and current_index < len(depths_and_times):
-            # Get the current depth and time
-            depth, time_in_min = depths_and_times[current_index]
-            safe_depth = min(depth, sonar_depth_limit)
-            safe_depth_cm = int(safe_depth * 100)  # Convert meters to centimeters
-            print(f"Publishing depth {safe_depth_cm} cm (index {current_index}).")
-            client.publish(setpoint_topic, safe_depth_cm)
-
-            # Wait for the duration specified
-            time.sleep(time_in_min * 60)
-            current_index += 1
-
-        elif state == "sampling" and current_index >= len(depths_and_times):
-            # All depths are processed; enter waiting state
-            print("All depths processed. Entering waiting state. Sending setpoint 0.")
-            state = "waiting"
-            client.publish(setpoint_topic, 0)
-
-        elif state == "waiting":
-            # In waiting state, publish 0 regularly
-            print("Waiting state: Publishing depth 0 cm.")
-            client.publish(setpoint_topic, 0)
-            time.sleep(10)  # Regular interval for waiting
-
-        elif state == "idle":
-            # In idle state, publish 0 regularly
-            print("Idle state: Publishing depth 0 cm.")
-            client.publish(setpoint_topic, 0)
-            time.sleep(10)  # Regular interval for idle publishing
+# Main function
+def main(shared_client=None, stop_event=None):
+    """Runs until interrupted, or until stop_event is set. master.py passes a shared client in single-process mode."""
+    global scheduler, engine
+    scheduler = Scheduler()
+
+    # Connect to MQTT broker, the network loop runs in the background
+    client = shared_client or mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
 
-        else:
-            time.sleep(1)  # Check the state periodically
+    def publish_setpoint(setpoint_cm):
+        client.publish(setpoint_topic, setpoint_cm)
 
+    def publish_station_done(report):
+        client.publish(station_done_topic, json.dumps(report, separators=(',', ':')))
 
-# Main function
-def main():
-    global depths_and_times
+    profile = None
+    if ADAPTIVE_PROFILE:
+        profile = AdaptiveProfile(ADAPTIVE_THRESHOLDS, ADAPTIVE_TIME_BUDGET, min_dwell_min=ADAPTIVE_MIN_DWELL,
+                                  min_spacing=ADAPTIVE_MIN_SPACING)
 
-    # Read depths and times from the file
-    depths_and_times = read_depths_and_times(file_path)
+    engine = MissionEngine(scheduler, publish_setpoint, send_udp_message, progress_file=progress_file,
+                           arrival_tolerance=ARRIVAL_TOLERANCE, arrival_timeout=ARRIVAL_TIMEOUT,
+                           station_done=publish_station_done if PUBLISH_STATION_DONE else None,
+                           profile=profile)
 
-    if not depths_and_times:
-        print("No valid file data. Generating default depths...")
-        generate_default_depths()
+    client.connect(broker_address)
+    client.loop_start()
 
-    # Start MQTT listener in a separate thread
-    threading.Thread(target=mqtt_listen, daemon=True).start()
+    # Resume an interrupted mission, otherwise read depths and times from the file
+    if not engine.resume():
+        file_depths = read_depths_and_times(file_path)
+        if file_depths:
+            engine.set_depths(file_depths)
+        else:
+            print("No valid file data. Generating default depths...")
+            engine.generate_default_depths()
+        engine.set_idle()
 
-    # Connect to MQTT broker for publishing
-    client = mqtt.Client()
-    client.connect(broker_address)
+    if stop_event is not None:
+        threading.Thread(target=lambda: (stop_event.wait(), scheduler.stop()), daemon=True).start()
 
-    # Start the sampling loop
-    sampling_loop(client)
+    # Run the mission engine, it reacts to MQTT events and dwell timers as they happen
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        client.loop_stop()
 
 
 if __name__ == "__main__":
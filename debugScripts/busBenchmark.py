@@ -0,0 +1,192 @@
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+# Scripts and message bus from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from logWriter import CsvLogWriter
+from messageBus import CallbackThread, MessageBus, MqttBridge, json_payload, message_json
+from probeSchema import load_schema
+
+# Measures the end-to-end latency of the two internal data paths, message by message:
+#   sonar -> setpoint: sonarToMQTT publishes the filtered depth, coordinator parses it and publishes
+#                      a winch setpoint, winchController receives the setpoint
+#   probe -> disk:     UDPtoMQTT publishes a probe frame, MQTTtoLOG parses it and writes the CSV row
+#                      (into the file buffer, as between MQTTtoLOG's flushes)
+# in three setups:
+#   broker - every script has its own MQTT connection (master.py RUN_MODE = "processes")
+#   bus    - the scripts share a message bus bridged to the broker, winchController is a separate
+#            MQTT client and the frames stay in process (RUN_MODE = "single", LOCAL_TOPICS)
+#   local  - message bus without a broker, everything in process (the lower bound)
+# The broker and bus setups need Mosquitto on BROKER_IP, without it only "local" runs.
+# CPU is the time used by this process, the broker's own CPU is not included.
+#
+# Usage: python busBenchmark.py [messages] [rate_hz]
+
+BROKER_IP = "127.0.0.1"
+BROKER_PORT = 1883
+# Not the real topics, so the benchmark can run on the boat: a running coordinator must not act on the
+# fake depths, the winch must not move and MQTTtoLOG must not log the fake frames
+SONAR_TOPIC = "bench/sonarDepthFiltered"
+SETPOINT_TOPIC = "bench/winchSetPoint"
+FRAME_TOPIC = "bench/frame"
+
+class Path:
+    """Send times and latencies of one measured path, messages are numbered by seq."""
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+        self.sent = {}
+        self.latencies = []
+        self.done = threading.Event()
+
+    def received(self, seq):
+        sent = self.sent.pop(seq, None)
+        if sent is not None:
+            self.latencies.append(time.perf_counter() - sent)
+            if len(self.latencies) == self.count:
+                self.done.set()
+
+    def report(self, setup):
+        lost = self.count - len(self.latencies)
+        if not self.latencies:
+            print(f"{setup:7s} {self.name:18s} no messages arrived")
+            return
+        ms = sorted(latency * 1000 for latency in self.latencies)
+        p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+        print(f"{setup:7s} {self.name:18s} median {statistics.median(ms):7.3f} ms  p95 {p95:7.3f} ms  "
+              f"max {ms[-1]:7.3f} ms  lost {lost}")
+
+def broker_client(on_message=None):
+    """Connected paho client with its network loop running, like a script in its own process."""
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(BROKER_IP, BROKER_PORT)
+    client.loop_start()
+    return client
+
+def setup_stages(make_client, sonar_path, frame_path, log_dir, remote_winch=None):
+    """
+    Builds the receiving scripts of both paths with the same handling as the real scripts.
+    Returns the sonar and probe publishing clients. The winch is remote_winch's client when given.
+    """
+    schema = load_schema()
+    writer = CsvLogWriter(log_dir, schema.field_names() + ["rx_time"])
+
+    # coordinator: parse the sonar message, publish the setpoint
+    def coordinator_message(client, userdata, message):
+        sonar = message_json(message)
+        if sonar["quality"] == "good":
+            client.publish(SETPOINT_TOPIC, sonar["seq"])  # The setpoint carries the sequence number
+
+    # winchController: parse the setpoint
+    def winch_message(client, userdata, message):
+        sonar_path.received(int(message.payload.decode()))
+
+    # MQTTtoLOG: parse the frame, write the row
+    def log_message(client, userdata, message):
+        frame = message_json(message)
+        writer.write(frame)
+        frame_path.received(frame["tidGaaet"])
+
+    make_client(coordinator_message).subscribe(SONAR_TOPIC)
+    (remote_winch or make_client)(winch_message).subscribe(SETPOINT_TOPIC)
+    make_client(log_message).subscribe(FRAME_TOPIC)
+    return make_client(None), make_client(None), writer
+
+def run_paths(sonar_client, probe_client, sonar_path, frame_path, rate_hz):
+    """Publishes both paths at rate_hz like sonarToMQTT and UDPtoMQTT do, returns the CPU time used."""
+    layout = load_schema().layouts[0]
+    interval = 1.0 / rate_hz
+    cpu_start = time.process_time()
+    next_send = time.perf_counter()
+    for seq in range(sonar_path.count):
+        sonar_path.sent[seq] = time.perf_counter()
+        sonar_client.publish(SONAR_TOPIC, json_payload(sonar_client, {
+            "depth": 12.34, "quality": "good", "confidence": 100, "seq": seq}))
+
+        fields = layout.simulate()
+        fields["tidGaaet"] = seq
+        frame_path.sent[seq] = time.perf_counter()
+        probe_client.publish(FRAME_TOPIC, json_payload(probe_client, dict(fields, rx_time=round(time.time(), 3))))
+
+        next_send += interval
+        time.sleep(max(0.0, next_send - time.perf_counter()))
+    sonar_path.done.wait(5)
+    frame_path.done.wait(5)
+    return time.process_time() - cpu_start
+
+def benchmark(setup, count, rate_hz):
+    sonar_path = Path("sonar -> setpoint", count)
+    frame_path = Path("probe -> disk", count)
+    log_dir = tempfile.mkdtemp(prefix="busBenchmark")
+    clients = []
+    loop = None
+    bridge = None
+
+    def make_paho(on_message):
+        client = broker_client(on_message)
+        clients.append(client)
+        return client
+
+    try:
+        if setup == "broker":
+            sonar_client, probe_client, writer = setup_stages(make_paho, sonar_path, frame_path, log_dir)
+        else:
+            # Publishers use an event loop thread, subscribers their own callback thread, like in master.py
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            bus = MessageBus(dispatch=loop.call_soon_threadsafe)
+            if setup == "bus":
+                bridge = MqttBridge(bus, BROKER_IP, BROKER_PORT, local_topics=[FRAME_TOPIC])
+                bridge.start()
+
+            def make_bus_client(on_message):
+                client = bus.client("bench", dispatch=CallbackThread("bench") if on_message else None)
+                client.on_message = on_message
+                client.loop_start()
+                return client
+
+            sonar_client, probe_client, writer = setup_stages(
+                make_bus_client, sonar_path, frame_path, log_dir, make_paho if setup == "bus" else None)
+        time.sleep(1)  # Let the connections and subscriptions settle
+
+        cpu = run_paths(sonar_client, probe_client, sonar_path, frame_path, rate_hz)
+        sonar_path.report(setup)
+        frame_path.report(setup)
+        print(f"{setup:7s} CPU {cpu * 1000 / count:.3f} ms per sonar and probe message pair")
+        writer.close()
+    finally:
+        for client in clients:
+            client.loop_stop()
+            client.disconnect()
+        if bridge is not None:
+            bridge.stop()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+def broker_running():
+    try:
+        with socket.create_connection((BROKER_IP, BROKER_PORT), timeout=1):
+            return True
+    except OSError:
+        return False
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+    setups = ["broker", "bus", "local"] if broker_running() else ["local"]
+    if setups == ["local"]:
+        print(f"No MQTT broker at {BROKER_IP}:{BROKER_PORT}, only the local setup is measured")
+    print(f"{count} messages per path at {rate_hz} Hz")
+    for setup in setups:
+        benchmark(setup, count, rate_hz)
@@ -0,0 +1,122 @@
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+# Mission engine from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from missionEngine import Scheduler, MissionEngine
+
+# Runs full coordinator missions against a simulated winch, sonar and operator on a simulated clock.
+# Sonar and operator messages are posted at high rate while the mission runs, and the mission state
+# is checked after every step. An hour long mission runs in well under a second.
+#
+# Usage: python missionSim.py [missions] [seed]
+
+WINCH_SPEED = 0.15      # m/s
+SONAR_INTERVAL = 0.5    # s between sonar messages
+SONAR_NOISE = 3.0       # m, sonar readings jump around the true depth by this much
+WINCH_STATE_INTERVAL = 1.0
+STEP = 0.5              # s of simulated time per step
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class SimWinch:
+    """Moves towards the last setpoint at WINCH_SPEED, like winchController does."""
+
+    def __init__(self):
+        self.position = 0.0
+        self.setpoint = 0.0
+
+    def set_setpoint(self, setpoint_cm):
+        self.setpoint = setpoint_cm / 100
+
+    def step(self, dt):
+        distance = self.setpoint - self.position
+        move = max(-WINCH_SPEED * dt, min(WINCH_SPEED * dt, distance))
+        self.position += move
+        return "idle" if abs(self.setpoint - self.position) < 1e-9 else "moving"
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+def run_mission(seed, bottom=25.0, stop_probability=0.0):
+    rng = random.Random(seed)
+    clock = SimClock()
+    scheduler = Scheduler(clock=clock)
+    winch = SimWinch()
+    setpoints = []
+    udp = []
+
+    def publish_setpoint(setpoint_cm):
+        setpoints.append(setpoint_cm)
+        winch.set_setpoint(setpoint_cm)
+
+    engine = MissionEngine(scheduler, publish_setpoint, udp.append, arrival_tolerance=0.05,
+                           arrival_timeout=600, clock=clock)
+    engine.on_sonar_depth(bottom)
+    engine.set_idle()
+    scheduler.post(engine.on_init_sampling, 1)
+
+    next_sonar = next_state = 0.0
+    mission_depths = None
+    stopped = False
+    while clock.now < 24 * 3600:
+        scheduler.run_due()
+        snapshot = engine.snapshot()
+
+        if snapshot["state"] == "sampling":
+            if mission_depths is None:
+                mission_depths = snapshot["depths_and_times"]
+            check(snapshot["depths_and_times"] == mission_depths, "depth list changed during the mission")
+            check(snapshot["mission_depth_limit"] <= bottom - 2, "mission limit below the bottom")
+            if snapshot["station_setpoint"] is not None:
+                check(snapshot["station_setpoint"] <= snapshot["mission_depth_limit"], "setpoint below the limit")
+        elif mission_depths is not None:
+            break
+
+        # High rate sonar, sometimes reading deeper than the bottom, and repeated operator commands
+        if clock.now >= next_sonar:
+            scheduler.post(engine.on_sonar_depth, bottom + rng.uniform(0, SONAR_NOISE))
+            scheduler.post(engine.on_init_sampling, 1)
+            next_sonar += SONAR_INTERVAL
+        if not stopped and mission_depths is not None and rng.random() < stop_probability:
+            scheduler.post(engine.on_init_sampling, 0)
+            stopped = True
+
+        state = winch.step(STEP)
+        if clock.now >= next_state:
+            scheduler.post(engine.on_winch_state, state, round(winch.position, 2))
+            next_state += WINCH_STATE_INTERVAL
+
+        clock.now += STEP
+
+    final = engine.snapshot()
+    check(final["state"] == ("idle" if stopped else "waiting"), f"mission ended in state {final['state']}")
+    check(setpoints[-1] == 0, "winch not parked at the end")
+    return clock.now, len(mission_depths or ()), setpoints
+
+def main():
+    missions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    start = time.perf_counter()
+    simulated = 0.0
+    for number in range(missions):
+        stop_probability = 0.0001 if number % 2 else 0.0
+        with contextlib.redirect_stdout(io.StringIO()):  # The engine prints every step
+            duration, stations, setpoints = run_mission(seed + number, stop_probability=stop_probability)
+        simulated += duration
+        print(f"Mission {number}: {stations} stations, {duration / 60:.1f} simulated min, setpoints {setpoints}")
+    elapsed = time.perf_counter() - start
+    print(f"{missions} missions, {simulated / 3600:.1f} simulated hours in {elapsed:.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import os
+import socket
+import sys
+import time
+
+# Probe packet schema shared with UDPtoMQTT (probe_schema.json in the repository root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from probeSchema import load_schema
+
+# Sends simulated probe packets to UDPtoMQTT, built from the packet schema
+def probe_simulator(server_ip='127.0.0.1', server_port=61557, layout_name='full', rate_hz=1.0):
+    schema = load_schema()
+    layout = schema.by_name[layout_name]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1.0 / rate_hz
+    tidGaaet = 0
+
+    print(f"Sending '{layout_name}' packets to {server_ip}:{server_port} at {rate_hz} Hz, Ctrl+C to stop")
+    try:
+        while True:
+            fields = layout.simulate()
+            fields["tidGaaet"] = tidGaaet
+            packet = layout.format(fields)
+            sock.sendto(packet.encode(), (server_ip, server_port))
+            print(f"Sent: {packet}")
+            tidGaaet += 1
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Exiting the simulator.")
+
+if __name__ == '__main__':
+    # Usage: probeSimulator.py [server_ip] [layout name] [rate in Hz]
+    args = sys.argv[1:]
+    probe_simulator(
+        server_ip=args[0] if len(args) > 0 else '127.0.0.1',
+        layout_name=args[1] if len(args) > 1 else 'full',
+        rate_hz=float(args[2]) if len(args) > 2 else 1.0,
+    )
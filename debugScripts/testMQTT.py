@@ -1,28 +1,19 @@
 import paho.mqtt.client as mqtt
-import random
 import time
 import threading
+import os
+import sys
 
 # MQTT Broker address
 BROKER = "arcmetis.local"
 
+# Probe packet schema shared with UDPtoMQTT (probe_schema.json in the repository root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from probeSchema import load_schema
+schema = load_schema()
+
 # MQTT Topics
-TOPICS = {
-    "probe/tidGaaet": None,
-    "probe/P_ude": None,
-    "probe/P_inde": None,
-    "probe/RH": None,
-    "probe/SCD30_temp": None,
-    "probe/htu_temp": None,
-    "probe/T_ude": None,
-    "probe/CO2": None,
-    "probe/O2": None,
-    "probe/CH4": None,
-    "probe/MIPEX": None,
-    "probe/EC": None,
-    "probe/Perc_bat": None,
-    "probe/P_diff": None
-}
+TOPICS = {f"probe/{name}": None for name in schema.field_names()}
 
 # Initialize MQTT client
 client = mqtt.Client()
@@ -38,23 +29,11 @@ def select_mode():
     mode = input("Enter your choice (1 or 2): ")
     return mode
 
-# Generate random data for each topic except tidGaaet
-def generate_random_data():
-    return {
-        "probe/P_ude": round(random.uniform(1000, 2000), 2),
-        "probe/P_inde": round(random.uniform(1000, 2000), 2),
-        "probe/RH": round(random.uniform(30, 60), 2),
-        "probe/SCD30_temp": round(random.uniform(18, 30), 2),
-        "probe/htu_temp": round(random.uniform(18, 30), 2),
-        "probe/T_ude": round(random.uniform(20, 40), 2),
-        "probe/CO2": round(random.uniform(300, 1000), 2),
-        "probe/O2": round(random.uniform(20, 22), 2),
-        "probe/CH4": round(random.uniform(0, 10), 2),
-        "probe/MIPEX": round(random.uniform(0, 10), 2),
-        "probe/EC": round(random.uniform(0, 1), 2),
-        "probe/Perc_bat": round(random.uniform(0, 100), 2),
-        "probe/P_diff": round(random.uniform(0, 10), 2)
-    }
+# Generate random data for each topic except tidGaaet, using the ranges from the schema
+def generate_random_data(layout_name="full"):
+    layout = schema.by_name[layout_name]
+    _, fields = schema.parse(layout.format(layout.simulate()))  # Parse to fill in derived fields like P_diff
+    return {f"probe/{name}": round(value, 2) for name, value in fields.items() if name != "tidGaaet"}
 
 # Publish data to MQTT broker
 def publish_data(mode):
@@ -64,23 +43,17 @@ def publish_data(mode):
         TOPICS["probe/tidGaaet"] = tidGaaet_counter
         tidGaaet_counter += 1
         
-        # Generate random data for other topics
-        random_data = generate_random_data()
-
         # Select data to send based on the mode
         if mode == "1":
             # Full data set
-            topics_to_publish = {**TOPICS, **random_data}
+            random_data = generate_random_data("full")
         elif mode == "2":
-            # Partial data set (specific topics)
-            topics_to_publish = {
-                "probe/tidGaaet": TOPICS["probe/tidGaaet"],
-                "probe/P_ude": random_data["probe/P_ude"],
-                "probe/Perc_bat": random_data["probe/Perc_bat"],
-            }
+            # Partial data set (topics of the short packet)
+            random_data = generate_random_data("short")
         else:
             print("Invalid mode selected. Exiting...")
             break
+        topics_to_publish = {"probe/tidGaaet": TOPICS["probe/tidGaaet"], **random_data}
 
         # Publish data to MQTT broker
         for topic, value in topics_to_publish.items():
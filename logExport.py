@@ -0,0 +1,83 @@
+#
+# Command line tool to convert binary logs written by MQTTtoLOG (LOG_FORMAT = "binary") to CSV.
+# Can slice by time range and select fields, only the selected records and columns are read.
+#
+# Examples:
+#   python logExport.py data_log_2025-06-01_10-00-00.bin -o day.csv
+#   python logExport.py data_log.bin --start "2025-06-01 12:00" --end "2025-06-01 13:00" --fields CH4,CO2,T_ude
+#   python logExport.py data_log.bin --info
+#
+
+import argparse
+import csv
+import sys
+from datetime import datetime, timezone
+from logWriter import BinaryLogReader
+
+def parse_time(text):
+    """Accepts a UNIX timestamp or a UTC date/time like '2025-06-01 12:00:00'."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"Invalid time '{text}', use a UNIX timestamp or 'YYYY-MM-DD HH:MM:SS' (UTC)")
+
+def print_info(reader):
+    print(f"File: {reader.path}")
+    print(f"Records: {len(reader)}")
+    for row in reader.info:
+        if row:
+            print("  " + ", ".join(str(item) for item in row))
+    if len(reader):
+        first = reader.value(0, reader.time_field)
+        last = reader.value(len(reader) - 1, reader.time_field)
+        print(f"Time range (UTC): {datetime.fromtimestamp(first, timezone.utc)} - {datetime.fromtimestamp(last, timezone.utc)}")
+    print("Fields:")
+    for name, code in zip(reader.fields, reader.formats):
+        print(f"  {name} [{reader.units.get(name, '')}] ({code})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an ARCLOG binary log to CSV.")
+    parser.add_argument("file", help="binary log file (.bin)")
+    parser.add_argument("-o", "--output", help="CSV file to write (default: standard output)")
+    parser.add_argument("--start", type=parse_time, help="first time to include (UNIX time or UTC date/time)")
+    parser.add_argument("--end", type=parse_time, help="first time to exclude (UNIX time or UTC date/time)")
+    parser.add_argument("--fields", help="comma separated list of fields to export (default: all)")
+    parser.add_argument("--no-info", action="store_true", help="leave out the info block at the top of the CSV")
+    parser.add_argument("--info", action="store_true", help="print the file header and time range and exit")
+    args = parser.parse_args()
+
+    with BinaryLogReader(args.file) as reader:
+        if args.info:
+            print_info(reader)
+            return
+
+        fields = args.fields.split(",") if args.fields else reader.fields
+        unknown = [name for name in fields if name not in reader.fields]
+        if unknown:
+            parser.error(f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(reader.fields)}")
+
+        output = open(args.output, 'w', newline='') if args.output else sys.stdout
+        try:
+            writer = csv.writer(output)
+            if not args.no_info:
+                writer.writerows(reader.info)
+            writer.writerow(fields)
+            count = 0
+            for row in reader.rows(args.start, args.end, fields):
+                writer.writerow(row)
+                count += 1
+        finally:
+            if args.output:
+                output.close()
+
+    if args.output:
+        print(f"Exported {count} rows to {args.output}")
+
+if __name__ == "__main__":
+    main()
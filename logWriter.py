@@ -0,0 +1,336 @@
+#
+# Long-lived log file writers used by MQTTtoLOG.
+# Rows are buffered in memory and written out every N rows or T seconds, the file is
+# fsync'ed when logging stops, and a new file is started when the current one gets too big or too old.
+#
+# Two formats are available:
+#   CsvLogWriter    - plain text CSV with an info block on top
+#   BinaryLogWriter - fixed-width binary records, see BinaryLogReader and logExport.py for reading
+#
+# Binary file layout (all little-endian):
+#   b"ARCLOG1\n"                magic
+#   uint32                      length of the JSON header
+#   JSON header                 {"fields": [...], "formats": [...], "units": {...}, "info": [...], "time_field": ...}
+#   records                     one struct per row, format "<" + "".join(formats), missing values are NaN
+# Records are appended in arrival order. The time field is wall-clock time, so it is only non-decreasing
+# while the clock is not stepped back (NTP or RTC corrections on the Pi). BinaryLogReader binary searches
+# it when it is sorted and falls back to checking every record when it is not.
+#
+
+import abc
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+# Defaults, MQTTtoLOG can override these
+FLUSH_ROWS = 50                    # Flush after this many buffered rows
+FLUSH_INTERVAL = 10                # ...or when the oldest buffered row is this many seconds old
+MAX_FILE_BYTES = 50 * 1024 * 1024  # Start a new file when the current one reaches this size
+MAX_FILE_AGE = 24 * 3600           # ...or after this many seconds
+FILE_BUFFER_SIZE = 64 * 1024       # Size of the Python file buffer in bytes
+
+BINARY_MAGIC = b"ARCLOG1\n"
+FLOAT32_MAX = 3.4028234663852886e38
+
+class LogWriter(abc.ABC):
+    """
+    Base class for a log file that stays open between rows, with buffered flushing and rotation.
+    Subclasses set file_extension and file_mode and implement write_header() and write_row().
+    """
+
+    file_extension = ""
+    file_mode = 'w'
+
+    def __init__(self, base_path, fieldnames, info_rows=None, prefix="data_log",
+                 flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=MAX_FILE_BYTES, max_age=MAX_FILE_AGE):
+        self.base_path = base_path
+        self.fieldnames = list(fieldnames)
+        self.info_rows = info_rows  # Callable returning the info block rows written at the top of each file
+        self.prefix = prefix
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.lock = threading.Lock()  # Rows arrive on the MQTT thread, tick() runs on the main thread
+        self.file = None
+        self.path = None
+        self.opened_at = 0
+        self.pending_rows = 0
+        self.pending_since = 0
+        self.rows_written = 0
+        self.open()
+
+    def open(self):
+        """Starts a new log file named after the current UTC time."""
+        current_time = datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S")
+        path = os.path.join(self.base_path, f"{self.prefix}_{current_time}{self.file_extension}")
+        part = 1
+        while os.path.exists(path):
+            part += 1
+            path = os.path.join(self.base_path, f"{self.prefix}_{current_time}_{part}{self.file_extension}")
+
+        self.path = path
+        if 'b' in self.file_mode:
+            self.file = open(path, mode=self.file_mode, buffering=FILE_BUFFER_SIZE)
+        else:
+            self.file = open(path, mode=self.file_mode, newline='', buffering=FILE_BUFFER_SIZE)
+        self.opened_at = time.monotonic()
+
+        self.write_header(self.info_rows() if self.info_rows else [])
+        self.flush(sync=True)
+        print(f"Opened log file {path}")
+
+    def write(self, row):
+        with self.lock:
+            if self.file is None:
+                print("Log file is closed, row dropped.")
+                return
+            self.write_row(row)
+            self.rows_written += 1
+            if self.pending_rows == 0:
+                self.pending_since = time.monotonic()
+            self.pending_rows += 1
+
+            if self.pending_rows >= self.flush_rows:
+                self.flush()
+            self.rotate_if_needed()
+
+    @abc.abstractmethod
+    def write_header(self, info_rows):
+        """Writes the start of a new file."""
+
+    @abc.abstractmethod
+    def write_row(self, row):
+        """Writes one row (dict of field name -> value)."""
+
+    def tick(self):
+        """Call periodically: flushes rows that have been buffered for too long and rotates old files."""
+        with self.lock:
+            if self.file is None:
+                return
+            if self.pending_rows and time.monotonic() - self.pending_since >= self.flush_interval:
+                self.flush()
+            self.rotate_if_needed()
+
+    def sync(self):
+        """Forces all rows written so far to the USB drive, e.g. while the winch moves between stations."""
+        with self.lock:
+            if self.file is not None:
+                self.flush(sync=True)
+
+    def flush(self, sync=False):
+        """Hands buffered rows to the OS. With sync=True they are also forced to the USB drive."""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.pending_rows = 0
+
+    def rotate_if_needed(self):
+        if self.file.tell() >= self.max_bytes or time.monotonic() - self.opened_at >= self.max_age:
+            self.close_file()
+            self.open()
+
+    def close_file(self):
+        self.flush(sync=True)
+        self.file.close()
+        self.file = None
+        print(f"Closed log file {self.path}")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.close_file()
+
+class CsvLogWriter(LogWriter):
+    """CSV log with the info block rows on top, followed by a header row and one row per sample."""
+
+    file_extension = ".csv"
+    file_mode = 'w'
+
+    def write_header(self, info_rows):
+        csv.writer(self.file).writerows(info_rows)
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+class BinaryLogWriter(LogWriter):
+    """
+    Binary log with one fixed-width record per sample. formats maps field name to a struct code
+    ('f' float32 by default, 'd' for values that need float64 like timestamps and counters).
+    If a row has no value for time_field the time of writing is used, so every record has a timestamp.
+    """
+
+    file_extension = ".bin"
+    file_mode = 'wb'
+
+    def __init__(self, base_path, fieldnames, formats=None, units=None, time_field="rx_time", **kwargs):
+        fieldnames = list(fieldnames)
+        if time_field not in fieldnames:
+            fieldnames.append(time_field)
+        formats = dict(formats or {})
+        formats.setdefault(time_field, 'd')
+        self.formats = [formats.get(name, 'f') for name in fieldnames]
+        self.units = units or {}
+        self.time_field = time_field
+        self.time_index = fieldnames.index(time_field)
+        self.record = struct.Struct("<" + "".join(self.formats))
+        super().__init__(base_path, fieldnames, **kwargs)
+
+    def write_header(self, info_rows):
+        header = json.dumps({
+            "fields": self.fieldnames,
+            "formats": self.formats,
+            "units": self.units,
+            "info": info_rows,
+            "time_field": self.time_field,
+        }).encode()
+        self.file.write(BINARY_MAGIC)
+        self.file.write(struct.pack("<I", len(header)))
+        self.file.write(header)
+
+    def write_row(self, row):
+        values = [to_float(row.get(name)) for name in self.fieldnames]
+        if math.isnan(values[self.time_index]):
+            values[self.time_index] = time.time()
+        try:
+            record = self.record.pack(*values)
+        except (OverflowError, struct.error):
+            # A value too large for float32, keep the row and log the value as missing
+            for index, code in enumerate(self.formats):
+                if code == 'f' and abs(values[index]) > FLOAT32_MAX:
+                    print(f"Value {values[index]} of {self.fieldnames[index]} does not fit float32, written as NaN")
+                    values[index] = math.nan
+            record = self.record.pack(*values)
+        self.file.write(record)
+
+def to_float(value):
+    """Converts a logged value to float, NaN for missing or non-numeric values."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+class BinaryLogReader:
+    """
+    Reads a BinaryLogWriter file through a memory map, so only the records and columns
+    that are asked for are touched. A partly written record at the end of the file is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        magic = self.file.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not an ARCLOG binary log file")
+        (header_length,) = struct.unpack("<I", self.file.read(4))
+        header = json.loads(self.file.read(header_length))
+
+        self.fields = header["fields"]
+        self.formats = header["formats"]
+        self.units = header.get("units", {})
+        self.info = header.get("info", [])
+        self.time_field = header["time_field"]
+        self.record = struct.Struct("<" + "".join(self.formats))
+        self.data_offset = len(BINARY_MAGIC) + 4 + header_length
+
+        # Byte offset of each field inside a record
+        self.offsets = {}
+        offset = 0
+        for name, code in zip(self.fields, self.formats):
+            self.offsets[name] = offset
+            offset += struct.calcsize("<" + code)
+
+        size = os.path.getsize(path)
+        self.count = max(0, (size - self.data_offset) // self.record.size)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.time_sorted = None  # Checked on the first time lookup
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def value(self, index, name):
+        code = self.formats[self.fields.index(name)]
+        position = self.data_offset + index * self.record.size + self.offsets[name]
+        return struct.unpack_from("<" + code, self.map, position)[0]
+
+    def is_time_sorted(self):
+        """True when the time field never goes backwards, so it can be binary searched."""
+        if self.time_sorted is None:
+            self.time_sorted = True
+            previous = -math.inf
+            for index in range(self.count):
+                current = self.value(index, self.time_field)
+                if current < previous:
+                    self.time_sorted = False
+                    break
+                previous = current
+        return self.time_sorted
+
+    def time_index(self, timestamp):
+        """Index of the first record with time >= timestamp (binary search, needs a sorted time field)."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.value(middle, self.time_field) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rows(self, start=None, end=None, fields=None):
+        """
+        Yields rows as tuples of the requested fields, for records with start <= time < end.
+        NaN values are returned as None, float32 values are rounded to the digits float32 actually holds.
+        """
+        fields = list(fields or self.fields)
+        if (start is not None or end is not None) and not self.is_time_sorted():
+            # The clock was stepped back while logging, check the time of every record
+            start = -math.inf if start is None else start
+            end = math.inf if end is None else end
+            wanted = [index for index in range(self.count) if start <= self.value(index, self.time_field) < end]
+        else:
+            first = self.time_index(start) if start is not None else 0
+            last = self.time_index(end) if end is not None else self.count
+            wanted = range(first, last)
+        cleaners = [clean_float32 if self.formats[self.fields.index(name)] == 'f' else clean_value for name in fields]
+
+        if fields == self.fields:
+            for index in wanted:
+                values = self.record.unpack_from(self.map, self.data_offset + index * self.record.size)
+                yield tuple(clean(v) for clean, v in zip(cleaners, values))
+            return
+
+        # Only read the requested columns of each record
+        readers = [(struct.Struct("<" + self.formats[self.fields.index(name)]), self.offsets[name]) for name in fields]
+        for index in wanted:
+            base = self.data_offset + index * self.record.size
+            values = (reader.unpack_from(self.map, base + offset)[0] for reader, offset in readers)
+            yield tuple(clean(v) for clean, v in zip(cleaners, values))
+
+def clean_value(value):
+    return None if math.isnan(value) else value
+
+def clean_float32(value):
+    return None if math.isnan(value) else float(f"{value:.7g}")
@@ -1,31 +1,387 @@
+#
+# Starts the ArcMetis scripts and keeps them running.
+#
+# Scripts are started in dependency order once what they need is ready: the MQTT broker must
+# accept connections, and a script counts as ready when it has published its first message on its
+# ready topic (or after its ready timeout). A script that exits is restarted with exponential
+# backoff. SIGTERM/SIGINT are forwarded to all scripts so they can shut down cleanly.
+# Uptime and restart counts of every script are published on status/processes.
+#
+# With RUN_MODE = "single" the scripts in IN_PROCESS run in this process instead: UDPtoMQTT on the
+# asyncio event loop, the others in worker threads, each with its own thread for its MQTT callbacks.
+# They share one MQTT connection through messageBus.py, and messages between them are delivered
+# directly without a broker round trip. winchController.py (GPIO) always runs as its own process.
+# The run mode only changes how the scripts are hosted, the same scripts run in both modes.
+#
+import asyncio
+import importlib
+import json
+import os
+import signal
+import socket
 import subprocess
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+import paho.mqtt.client as mqtt
+from messageBus import CallbackThread, MessageBus, MqttBridge
 
 # Path to the virtual environment's Python executable
 venv_python = '/home/arcmetis/ArcMetis/.venv/bin/python3'
 
-# List of scripts to run, excluding MQTTstatus.py for  ,
-scripts = [
-    'UDPtoMQTT.py',
-    'winchController.py',
-    'MQTTtoLOG.py',
-    'sonarToMQTT.py',
-    'MAVtoMQTT.py',
+BROKER_IP = "127.0.0.1"
+BROKER_PORT = 1883
+PROCESS_TOPIC = "status/processes"
+
+# Scripts to run:
+#   depends_on    - scripts that must be ready before this one is started
+#   ready_topic   - first message on this topic after the start means the script is ready
+#   ready_timeout - s, count it as ready anyway after this long (also used when there is no ready topic)
+SERVICES = [
+    {"script": 'UDPtoMQTT.py', "depends_on": [], "ready_topic": None, "ready_timeout": 2},
+    {"script": 'winchController.py', "depends_on": [], "ready_topic": "platform/winchState", "ready_timeout": 30},
+    {"script": 'MQTTtoLOG.py', "depends_on": [], "ready_topic": "status/noUSB", "ready_timeout": 10},
+    {"script": 'sonarToMQTT.py', "depends_on": [], "ready_topic": "platform/sonarDepth", "ready_timeout": 30},
+    {"script": 'MAVtoMQTT.py', "depends_on": [], "ready_topic": "status/mavError", "ready_timeout": 30},
+    # Acts on the filtered sonar depth and drives the winch, publishes nothing until a mission runs
+    {"script": 'coordinator.py', "depends_on": ['sonarToMQTT.py', 'winchController.py'],
+     "ready_topic": None, "ready_timeout": 5},
+    # Started last so the alarms do not fire while the other scripts come up
+    {"script": 'MQTTstatus.py',
+     "depends_on": ['UDPtoMQTT.py', 'winchController.py', 'MQTTtoLOG.py', 'sonarToMQTT.py', 'MAVtoMQTT.py'],
+     "ready_topic": "status/alarmSet", "ready_timeout": 10},
 ]
 
-# Start each script in parallel (except MQTTstatus.py)
-processes = []
-for script in scripts:
-    process = subprocess.Popen([venv_python, script])
-    processes.append(process)
+# "processes" - every script is its own process with its own MQTT connection
+# "single"    - the IN_PROCESS scripts run in this process and share one MQTT connection
+RUN_MODE = "processes"
+IN_PROCESS = ['UDPtoMQTT.py', 'MAVtoMQTT.py', 'sonarToMQTT.py', 'MQTTtoLOG.py', 'coordinator.py', 'MQTTstatus.py']
+# Internal topics: topic filter -> the scripts that subscribe to it. In single mode a topic is only
+# delivered in process (never sent to the broker, never JSON encoded) when all of its subscribers run
+# in process, otherwise it is bridged as usual. Only list topics nothing else (displays, debugScripts)
+# reads, the dashboard uses the per-field probe topics rather than probe/frame.
+LOCAL_TOPICS = {
+    "probe/frame": ['MQTTtoLOG.py', 'MQTTstatus.py', 'coordinator.py'],  # coordinator with ADAPTIVE_PROFILE
+}
+
+# Restart policy
+RESTART_DELAY = 1        # s before the first restart
+RESTART_DELAY_MAX = 60   # s, the delay doubles after every crash up to this
+STABLE_TIME = 60         # s, a script that ran this long starts again from RESTART_DELAY
+DEPENDENCY_TIMEOUT = 60  # s, start a script anyway when its dependencies are not ready by then
+STOP_TIMEOUT = 10        # s to wait for scripts to exit after SIGTERM before they are killed
+STATUS_INTERVAL = 10     # s between status/processes messages
+BROKER_WAIT = 2          # s between checks for the broker at startup
+
+class Service:
+    """One supervised script."""
+
+    def __init__(self, script, depends_on, ready_topic, ready_timeout):
+        self.script = script
+        self.depends_on = depends_on
+        self.ready_topic = ready_topic
+        self.ready_timeout = ready_timeout
+        self.process = None
+        self.started_at = None
+        self.ready = False
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.next_start = 0.0  # Earliest time it may be (re)started
+        self.waiting_since = None  # When it started waiting for its dependencies
+
+    def start(self):
+        print(f"Starting {self.script}")
+        self.process = subprocess.Popen([venv_python, self.script])
+        self.started_at = time.monotonic()
+        self.ready = False
+        self.waiting_since = None
+
+    def may_start(self, now):
+        """True when the restart delay is over and the dependencies are ready (or have taken too long)."""
+        if now < self.next_start:
+            return False
+        if all(by_script[name].ready for name in self.depends_on):
+            return True
+        if self.waiting_since is None:
+            self.waiting_since = now
+        if now - self.waiting_since >= DEPENDENCY_TIMEOUT:
+            waiting = [name for name in self.depends_on if not by_script[name].ready]
+            print(f"Starting {self.script} without waiting longer for {', '.join(waiting)}")
+            return True
+        return False
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def check_ready(self, now):
+        if self.running() and not self.ready and now - self.started_at >= self.ready_timeout:
+            print(f"{self.script} ready (no message after {self.ready_timeout} s)")
+            self.ready = True
+
+    def exited(self, now):
+        """Called when the process has exited, schedules the restart."""
+        code = self.process.returncode
+        uptime = now - self.started_at
+        if uptime >= STABLE_TIME:
+            self.delay = RESTART_DELAY
+        print(f"{self.script} exited with code {code} after {uptime:.0f} s, restarting in {self.delay} s")
+        self.process = None
+        self.ready = False
+        self.restarts += 1
+        self.next_start = now + self.delay
+        self.delay = min(self.delay * 2, RESTART_DELAY_MAX)
+
+    def status(self, now):
+        return {
+            "running": self.running(),
+            "ready": self.ready,
+            "pid": self.process.pid if self.process else None,
+            "uptime": round(now - self.started_at) if self.running() else 0,
+            "restarts": self.restarts,
+        }
+
+class InProcessScript:
+    """One script run in this process (RUN_MODE = "single"), restarted with the same policy as a process."""
+
+    def __init__(self, script, depends_on):
+        self.script = script
+        self.depends_on = depends_on
+        self.module = None
+        self.running = False
+        self.started_at = None
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+
+    @property
+    def ready(self):
+        return self.running
+
+    async def wait_for_dependencies(self, stop_event):
+        """Waits until the scripts this one depends on are ready, or DEPENDENCY_TIMEOUT has passed."""
+        deadline = time.monotonic() + DEPENDENCY_TIMEOUT
+        while not stop_event.is_set():
+            waiting = [name for name in self.depends_on if not by_script[name].ready]
+            if not waiting:
+                return
+            if time.monotonic() >= deadline:
+                print(f"Starting {self.script} without waiting longer for {', '.join(waiting)}")
+                return
+            await asyncio.sleep(0.5)
+
+    def load(self):
+        """Imports the script, or reloads it after a crash so it starts with fresh module state like a process."""
+        if self.module is None:
+            self.module = importlib.import_module(self.script[:-3])
+        else:
+            self.module = importlib.reload(self.module)
+        return self.module
+
+    async def run(self, bus, executor, stop_event):
+        loop = asyncio.get_running_loop()
+        while not stop_event.is_set():
+            await self.wait_for_dependencies(stop_event)
+            if stop_event.is_set():
+                break
+            print(f"Starting {self.script} in process")
+            # UDPtoMQTT's callbacks run on the event loop, the other scripts' on their own thread
+            callbacks = None if self.script == 'UDPtoMQTT.py' else CallbackThread(self.script)
+            client = bus.client(self.script, dispatch=callbacks)
+            self.running = True
+            self.started_at = time.monotonic()
+            try:
+                # A failed import (e.g. a missing driver) is restarted like a crash
+                module = self.load()
+                if self.script == 'UDPtoMQTT.py':
+                    # Already asyncio, runs on the event loop until it fails or is cancelled at shutdown
+                    task = asyncio.ensure_future(module.serve(client=client))
+                    while not task.done() and not stop_event.is_set():
+                        await asyncio.sleep(0.5)
+                    task.cancel()
+                    result = await asyncio.gather(task, return_exceptions=True)
+                    code = None if isinstance(result[0], asyncio.CancelledError) else result[0]
+                else:
+                    code = await loop.run_in_executor(
+                        executor, lambda: module.main(shared_client=client, stop_event=stop_event))
+            except Exception as e:
+                code = e
+            finally:
+                self.running = False
+                bus.remove(client)
+                if callbacks is not None:
+                    callbacks.stop()
+            if stop_event.is_set():
+                break
+
+            uptime = time.monotonic() - self.started_at
+            if uptime >= STABLE_TIME:
+                self.delay = RESTART_DELAY
+            print(f"{self.script} ended ({code!r}) after {uptime:.0f} s, restarting in {self.delay} s")
+            self.restarts += 1
+            await asyncio.sleep(self.delay)
+            self.delay = min(self.delay * 2, RESTART_DELAY_MAX)
+
+    def status(self, now):
+        return {
+            "running": self.running,
+            "ready": self.ready,
+            "pid": os.getpid() if self.running else None,
+            "uptime": round(now - self.started_at) if self.running else 0,
+            "restarts": self.restarts,
+        }
+
+def local_topics():
+    """The LOCAL_TOPICS whose subscribers all run in this process."""
+    topics = []
+    for topic, subscribers in LOCAL_TOPICS.items():
+        outside = [script for script in subscribers if script not in IN_PROCESS]
+        if outside:
+            print(f"Bridging {topic} to the broker, {', '.join(outside)} does not run in process")
+        else:
+            topics.append(topic)
+    return topics
+
+# Scripts run as processes, in single mode only the ones that cannot run in process
+services = [Service(**service) for service in SERVICES
+            if RUN_MODE != "single" or service["script"] not in IN_PROCESS]
+in_process = [InProcessScript(service["script"], service["depends_on"]) for service in SERVICES
+              if RUN_MODE == "single" and service["script"] in IN_PROCESS]
+by_script = {script.script: script for script in services + in_process}
+stopping = False
+
+def broker_reachable():
+    try:
+        with socket.create_connection((BROKER_IP, BROKER_PORT), timeout=1):
+            return True
+    except OSError:
+        return False
+
+def on_connect(client, userdata, flags, rc):
+    topics = {service.ready_topic for service in services if service.ready_topic}
+    client.subscribe([(topic, 0) for topic in topics])
+
+# A message on a ready topic marks the script that publishes it as ready
+def on_message(client, userdata, msg):
+    for service in services:
+        if service.ready_topic == msg.topic and service.running() and not service.ready:
+            print(f"{service.script} ready")
+            service.ready = True
+
+# Forward SIGTERM/SIGINT: stop the supervisor loop, which then stops the scripts
+def handle_signal(signum, frame):
+    global stopping
+    stopping = True
+
+def stop_all():
+    for service in services:
+        if service.running():
+            service.process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for service in services:
+        if service.process is None:
+            continue
+        try:
+            service.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"{service.script} did not stop, killing it")
+            service.process.kill()
+            service.process.wait()
+
+def publish_status(client, now):
+    status = {service.script: service.status(now) for service in services + in_process}
+    client.publish(PROCESS_TOPIC, json.dumps(status, separators=(',', ':')), retain=True)
+
+def wait_for_broker():
+    # Every script needs the broker, wait for it instead of a fixed delay
+    while not broker_reachable() and not stopping:
+        print(f"Waiting for the MQTT broker at {BROKER_IP}:{BROKER_PORT}...")
+        time.sleep(BROKER_WAIT)
+
+def supervise(client):
+    """Starts and restarts the script processes until stopping is set, then stops them."""
+    next_status = 0.0
+    try:
+        while not stopping:
+            now = time.monotonic()
+            changed = False
+            for service in services:
+                if service.process is not None:
+                    if service.running():
+                        service.check_ready(now)
+                    else:
+                        service.exited(now)
+                        changed = True
+                elif service.may_start(now):
+                    service.start()
+                    changed = True
+
+            # Publish right away when a script started or exited, otherwise every STATUS_INTERVAL
+            if changed or now >= next_status:
+                publish_status(client, now)
+                next_status = now + STATUS_INTERVAL
+            time.sleep(0.5)
+    finally:
+        print("Stopping all scripts...")
+        stop_all()
+        publish_status(client, time.monotonic())
+
+async def run_single_process():
+    loop = asyncio.get_running_loop()
+    stop_event = threading.Event()
+
+    def stop():
+        global stopping
+        stopping = True
+        stop_event.set()
+
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    loop.add_signal_handler(signal.SIGINT, stop)
+
+    await asyncio.to_thread(wait_for_broker)
+    if stopping:
+        return
+
+    # Callbacks without their own thread (UDPtoMQTT's and this supervisor's) run on the event loop
+    bus = MessageBus(dispatch=loop.call_soon_threadsafe)
+    bridge = MqttBridge(bus, BROKER_IP, BROKER_PORT, local_topics=local_topics())
+    bridge.start()
+
+    client = bus.client("master.py")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.loop_start()
+
+    # One thread per blocking script, plus the supervisor of the remaining processes
+    executor = ThreadPoolExecutor(max_workers=len(in_process) + 1)
+    try:
+        await asyncio.gather(
+            loop.run_in_executor(executor, supervise, client),
+            *(script.run(bus, executor, stop_event) for script in in_process),
+        )
+    finally:
+        # Also stop everything when a task failed, so no script thread is left running
+        stop()
+        executor.shutdown(wait=False)
+        bridge.stop()
+
+def main():
+    if RUN_MODE == "single":
+        asyncio.run(run_single_process())
+        return
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
 
-# Delay for 30 seconds
-time.sleep(30)
+    wait_for_broker()
 
-# Start MQTTstatus.py
-mqtt_status_process = subprocess.Popen([venv_python, 'MQTTstatus.py'])
-processes.append(mqtt_status_process)
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect_async(BROKER_IP, BROKER_PORT, keepalive=60)
+    client.loop_start()
+    try:
+        supervise(client)
+    finally:
+        client.loop_stop()
 
-# Optionally wait for all processes to complete
-for process in processes:
-    process.wait()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+#
+# In-process message bus, used when master.py runs the scripts in one process (RUN_MODE = "single").
+#
+# Every script gets a BusClient, which looks like a paho mqtt.Client to the script (on_connect,
+# on_message, subscribe, publish, ...). A publish is delivered directly to the scripts in the process
+# that subscribed to a matching topic, and sent to the broker over one shared MQTT connection
+# (MqttBridge) for everything outside the process. Messages from the broker are delivered to the
+# subscribed scripts the same way.
+#
+# The bridge subscribes with the MQTT v5 "no local" option, so the broker does not send the
+# process's own publishes back and local subscribers see every message once.
+#
+# A client's callbacks run one at a time, in order, through its dispatch function, like they run on
+# paho's network thread when every script has its own client. master.py gives every thread-hosted
+# script its own CallbackThread, so one script's slow callback (MQTTtoLOG's file I/O) does not hold up
+# the others or the asyncio event loop. Clients without their own dispatch use the bus's.
+#
+# Payloads are not serialized for local delivery: a dict or list passed to publish() reaches local
+# subscribers as the same object (message.value), and is only encoded to JSON when message.payload
+# is read, which the bridge does when it sends the message to the broker. Scripts use json_payload()
+# and message_json() so the same code works with a BusClient and with a plain paho client.
+# Subscribers must not modify a received value, the publisher and the other subscribers share it,
+# and they may use it on other threads at the same time.
+# Topics in the bridge's local_topics never go to the broker, for data no one outside the process uses.
+#
+
+import itertools
+import json
+import queue
+import threading
+import paho.mqtt.client as mqtt
+from paho.mqtt.subscribeoptions import SubscribeOptions
+
+def topic_matches(pattern, topic):
+    """MQTT topic filter matching with + and # wildcards."""
+    if pattern == topic:
+        return True
+    if topic.startswith('$') and not pattern.startswith('$'):
+        return False  # Wildcards do not match $SYS and friends
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+PAYLOAD_TYPES = (bytes, bytearray, str, int, float, dict, list, type(None))
+
+def encode_payload(payload):
+    """Payload as bytes, converted the way paho converts it. Dicts and lists become compact JSON."""
+    if payload is None:
+        return b''
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, bytearray):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    if isinstance(payload, (dict, list)):
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    raise TypeError("payload must be a string, bytearray, int, float, dict, list or None.")
+
+def json_payload(client, value):
+    """Payload for publishing a dict or list: the object itself on a BusClient, compact JSON otherwise."""
+    if isinstance(client, BusClient):
+        return value
+    return json.dumps(value, separators=(',', ':'))
+
+def message_json(message):
+    """
+    The dict or list a message carries: the published object for a local message, decoded JSON otherwise.
+    A local object is shared with the publisher and the other subscribers, which may be on other threads:
+    read it, never modify it.
+    """
+    value = getattr(message, "value", None)
+    if isinstance(value, (dict, list)):
+        return value
+    return json.loads(message.payload)
+
+class Message:
+    """Same attributes as paho's MQTTMessage, plus value: the object that was published locally."""
+    __slots__ = ("topic", "value", "qos", "retain", "mid", "_payload")
+
+    def __init__(self, topic, payload=None, qos=0, retain=False, mid=0, value=None):
+        self.topic = topic
+        self.value = value
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self._payload = payload  # None until value is encoded
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = encode_payload(self.value)
+        return self._payload
+
+class PublishResult:
+    """Stands in for paho's MQTTMessageInfo, a local publish is done when publish() returns."""
+    __slots__ = ("mid", "rc")
+
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+class MessageBus:
+    """Topic-matching delivery between BusClients, and to and from the broker when a bridge is attached."""
+
+    def __init__(self, dispatch=None):
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.lock = threading.Lock()
+        self.exact = {}     # Topic without wildcards -> set of clients
+        self.wildcard = {}  # Topic filter with wildcards -> set of clients
+        self.retained = {}  # Topic -> last retained local Message
+        self.clients = []
+        self.bridge = None
+        self.connected = True  # Broker connection up, always True without a bridge
+        self.mids = itertools.count(1)
+
+    def client(self, name, dispatch=None):
+        """New BusClient. Its callbacks run through dispatch, or the bus's dispatch when None."""
+        client = BusClient(self, name, dispatch)
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def remove(self, client):
+        """Drops a client and its subscriptions, used when master.py restarts a script."""
+        for pattern in list(client.subscriptions):
+            self.unsubscribe(client, pattern)
+        client.subscriptions.clear()
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def attach(self, bridge):
+        self.bridge = bridge
+        self.connected = bridge.connected
+
+    # --- Subscriptions ---
+
+    def subscribe(self, client, pattern):
+        with self.lock:
+            table = self.wildcard if '+' in pattern or '#' in pattern else self.exact
+            table.setdefault(pattern, set()).add(client)
+            retained = [message for topic, message in self.retained.items() if topic_matches(pattern, topic)]
+        if self.bridge is not None:
+            self.bridge.subscribe(pattern)
+        for message in retained:
+            client.dispatch(client.deliver, message)
+
+    def unsubscribe(self, client, pattern):
+        with self.lock:
+            for table in (self.exact, self.wildcard):
+                clients = table.get(pattern)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del table[pattern]
+        if self.bridge is not None:
+            self.bridge.unsubscribe(pattern)
+
+    def subscribers(self, topic):
+        with self.lock:
+            clients = set(self.exact.get(topic, ()))
+            for pattern, matching in self.wildcard.items():
+                if topic_matches(pattern, topic):
+                    clients.update(matching)
+        return clients
+
+    # --- Messages ---
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not isinstance(payload, PAYLOAD_TYPES):
+            raise TypeError("payload must be a string, bytearray, int, float, dict, list or None.")
+        message = Message(topic, qos=qos, retain=retain, mid=next(self.mids), value=payload)
+        if retain:
+            with self.lock:
+                if payload not in (None, b'', ''):
+                    self.retained[topic] = message
+                else:
+                    self.retained.pop(topic, None)
+        self.deliver(message)
+        if self.bridge is not None:
+            self.bridge.publish(message)
+        return PublishResult(message.mid)
+
+    def deliver(self, message):
+        """Hands the message to every client subscribed to its topic, through each client's dispatch."""
+        for client in self.subscribers(message.topic):
+            client.dispatch(client.deliver, message)
+
+    # --- Connection state ---
+
+    def set_connected(self, connected, rc=0):
+        self.connected = connected
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.dispatch(client.notify_connected if connected else client.notify_disconnected, rc)
+
+class BusClient:
+    """The part of paho's mqtt.Client the scripts use, backed by a MessageBus."""
+
+    def __init__(self, bus, name, dispatch=None):
+        self.bus = bus
+        self.name = name
+        self.dispatch = dispatch or bus.dispatch
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.userdata = None
+        self.started = False  # The script asked to connect
+        self.subscriptions = set()
+
+    def __repr__(self):
+        return f"BusClient({self.name!r})"
+
+    # Connection handling belongs to the bridge, these only tell the script when it is connected
+    def connect(self, *args, **kwargs):
+        self.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    connect_async = connect
+    reconnect = connect
+
+    def loop_start(self):
+        self.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect_delay_set(self, *args, **kwargs):
+        pass
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def is_connected(self):
+        return self.bus.connected
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            if self.bus.connected:
+                self.dispatch(self.notify_connected, 0)
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        if isinstance(topic, tuple):
+            topic = [topic]
+        patterns = [topic] if isinstance(topic, str) else [item[0] for item in topic]
+        for pattern in patterns:
+            if pattern in self.subscriptions:
+                continue  # Resubscribed from on_connect, the bus and the bridge already have it
+            self.subscriptions.add(pattern)
+            self.bus.subscribe(self, pattern)
+        return mqtt.MQTT_ERR_SUCCESS, next(self.bus.mids)
+
+    def unsubscribe(self, topic, **kwargs):
+        for pattern in [topic] if isinstance(topic, str) else topic:
+            if pattern in self.subscriptions:
+                self.subscriptions.discard(pattern)
+                self.bus.unsubscribe(self, pattern)
+        return mqtt.MQTT_ERR_SUCCESS, next(self.bus.mids)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        return self.bus.publish(topic, payload, qos, retain)
+
+    # --- Called through dispatch ---
+
+    def deliver(self, message):
+        if self.on_message is not None:
+            try:
+                self.on_message(self, self.userdata, message)
+            except Exception as e:  # One script's bug must not stop delivery to the others
+                print(f"{self.name}: error handling message on {message.topic}: {e}")
+
+    def notify_connected(self, rc):
+        if self.started and self.on_connect is not None:
+            try:
+                self.on_connect(self, self.userdata, {}, 0)
+            except Exception as e:
+                print(f"{self.name}: error in on_connect: {e}")
+
+    def notify_disconnected(self, rc):
+        if self.started and self.on_disconnect is not None:
+            try:
+                self.on_disconnect(self, self.userdata, rc)
+            except Exception as e:
+                print(f"{self.name}: error in on_disconnect: {e}")
+
+class CallbackThread:
+    """Runs callbacks one at a time, in order, on its own thread. Use as the dispatch of a BusClient."""
+
+    def __init__(self, name):
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def __call__(self, callback, *args):
+        self.queue.put((callback, args))
+
+    def run(self):
+        while True:
+            callback, args = self.queue.get()
+            if callback is None:
+                return
+            callback(*args)
+
+    def stop(self):
+        """Ends the thread after the callbacks already queued."""
+        self.queue.put((None, ()))
+
+class MqttBridge:
+    """The one broker connection of the process. Forwards local publishes out and broker messages in."""
+
+    def __init__(self, bus, broker, port=1883, keepalive=60, local_topics=()):
+        self.bus = bus
+        self.broker = broker
+        self.port = port
+        self.keepalive = keepalive
+        self.local_topics = list(local_topics)  # Topic filters that are only delivered inside the process
+        self.lock = threading.Lock()
+        self.patterns = {}  # Topic filter -> number of local subscriptions
+        self.connected = False
+
+        self.client = mqtt.Client(protocol=mqtt.MQTTv5)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        bus.attach(self)
+
+    def start(self):
+        self.client.connect_async(self.broker, self.port, keepalive=self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def is_local(self, topic):
+        return any(topic_matches(pattern, topic) for pattern in self.local_topics)
+
+    def subscribe(self, pattern):
+        if self.is_local(pattern):
+            return  # Nothing on the broker for it
+        with self.lock:
+            self.patterns[pattern] = self.patterns.get(pattern, 0) + 1
+            first = self.patterns[pattern] == 1
+        if first and self.connected:
+            self.client.subscribe(pattern, options=SubscribeOptions(qos=0, noLocal=True))
+
+    def unsubscribe(self, pattern):
+        if self.is_local(pattern):
+            return
+        with self.lock:
+            count = self.patterns.get(pattern, 0) - 1
+            if count > 0:
+                self.patterns[pattern] = count
+                return
+            self.patterns.pop(pattern, None)
+        if self.connected:
+            self.client.unsubscribe(pattern)
+
+    def publish(self, message):
+        if self.is_local(message.topic):
+            return  # Encoded only when it leaves the process
+        self.client.publish(message.topic, message.payload, message.qos, message.retain)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            print(f"Message bus: failed to connect to MQTT broker, return code {rc}")
+            return
+        print("Message bus: connected to MQTT broker.")
+        self.connected = True
+        with self.lock:
+            patterns = list(self.patterns)
+        if patterns:
+            client.subscribe([(pattern, SubscribeOptions(qos=0, noLocal=True)) for pattern in patterns])
+        self.bus.set_connected(True)
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        print(f"Message bus: disconnected from MQTT broker (rc={rc}), reconnecting...")
+        self.connected = False
+        self.bus.set_connected(False, rc)
+
+    def on_message(self, client, userdata, msg):
+        self.bus.deliver(Message(msg.topic, msg.payload, msg.qos, msg.retain, msg.mid))
@@ -0,0 +1,372 @@
+#
+# Event-driven mission engine for the coordinator.
+#
+# Everything that changes the mission runs on one thread, from a scheduler that holds a queue of
+# posted events (MQTT messages) and a priority queue of deadlines (dwell timers). The thread sleeps
+# until the next deadline or until an event is posted, so an operator command is acted on immediately
+# instead of after the current dwell.
+#
+# The dwell time at a station is counted from when the winch reports that it is idle at the setpoint,
+# so the time spent lowering the probe does not cut into the sampling time at depth.
+#
+# Mission progress is saved to a file after every change, so a restarted coordinator resumes the
+# profile at the station it was at.
+#
+
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+class Scheduler:
+    """Runs posted events and timed callbacks on one thread."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.events = []
+        self.timers = []  # Heap of (deadline, sequence number, callback)
+        self.cancelled = set()
+        self.sequence = itertools.count()
+        self.running = True
+
+    def post(self, callback, *args):
+        """Queues callback(*args) to run on the scheduler thread as soon as possible. Safe from any thread."""
+        with self.condition:
+            self.events.append((callback, args))
+            self.condition.notify()
+
+    def call_later(self, delay, callback):
+        """Runs callback after delay seconds. Returns a handle for cancel()."""
+        with self.condition:
+            handle = next(self.sequence)
+            heapq.heappush(self.timers, (self.clock() + delay, handle, callback))
+            self.condition.notify()
+            return handle
+
+    def cancel(self, handle):
+        if handle is not None:
+            with self.condition:
+                self.cancelled.add(handle)
+
+    def next_deadline(self):
+        """Deadline of the earliest pending timer, None if there is none."""
+        with self.condition:
+            self.drop_cancelled()
+            return self.timers[0][0] if self.timers else None
+
+    def drop_cancelled(self):
+        while self.timers and self.timers[0][1] in self.cancelled:
+            self.cancelled.discard(heapq.heappop(self.timers)[1])
+
+    def run_due(self):
+        """Runs all posted events, then all timers that are due. Returns the number of callbacks run."""
+        count = 0
+        while True:
+            with self.condition:
+                if self.events:
+                    callback, args = self.events.pop(0)
+                else:
+                    self.drop_cancelled()
+                    if not self.timers or self.timers[0][0] > self.clock():
+                        return count
+                    _, _, callback = heapq.heappop(self.timers)
+                    args = ()
+            callback(*args)
+            count += 1
+
+    def run_forever(self):
+        while self.running:
+            self.run_due()
+            with self.condition:
+                if self.events or not self.running:
+                    continue
+                self.drop_cancelled()
+                timeout = self.timers[0][0] - self.clock() if self.timers else None
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+# Mission state machine: event -> {state it is allowed in: state it leads to}.
+# Events that are not allowed in the current state are ignored.
+TRANSITIONS = {
+    "start": {"idle": "sampling", "waiting": "sampling"},
+    "finish": {"sampling": "waiting"},
+    "stop": {"sampling": "idle", "waiting": "idle"},
+}
+
+class MissionEngine:
+    """
+    Sampling mission: visits each (depth [m], time [min]) station in turn.
+      publish_setpoint(cm) - sends the winch setpoint
+      send_udp(message)    - sends a command to the probe
+      station_done(report) - optional, called with a dict when a station's dwell is over and the
+                             winch starts on the next move, e.g. to flush logs while it travels
+      profile              - optional AdaptiveProfile that adds stations and shortens dwells from probe data
+    All methods must be called on the scheduler thread (use scheduler.post from other threads),
+    except snapshot() which can be called from any thread.
+
+    The depth list and the sonar depth limit are frozen while a mission runs. Sonar updates during
+    a mission only apply once it ends, except that a shallower limit still clamps the remaining
+    setpoints so the probe is never sent below the bottom.
+    """
+
+    def __init__(self, scheduler, publish_setpoint, send_udp, progress_file=None,
+                 arrival_tolerance=0.1, arrival_timeout=600, station_done=None, profile=None, clock=time.time):
+        self.scheduler = scheduler
+        self.publish_setpoint = publish_setpoint
+        self.send_udp = send_udp
+        self.progress_file = progress_file
+        self.arrival_tolerance = arrival_tolerance  # m, the winch counts as arrived within this of the setpoint
+        self.arrival_timeout = arrival_timeout      # s, start the dwell without an arrival report after this long
+        self.station_done = station_done
+        self.profile = profile
+        self.clock = clock
+
+        # Guards everything snapshot() reads; the fields are only changed on the scheduler thread
+        self.lock = threading.RLock()
+        self.state = "idle"  # "idle", "sampling" or "waiting"
+        self.depths_and_times = ()  # Tuple of (depth, time) tuples, replaced as a whole and never changed in place
+        self.depths_source = None   # "file" or "default"; default depths follow the sonar between missions
+        self.current_index = 0
+        self.sonar_depth_limit = float('inf')    # Latest limit from the sonar
+        self.mission_depth_limit = float('inf')  # Limit in use by the running mission
+        self.station_setpoint = None  # Setpoint of the current station in m
+        self.published_at = None  # When the current setpoint was published
+        self.arrived_at = None    # When the winch reached it, the dwell runs from here
+        self.dwell_timer = None
+        self.arrival_timer = None
+
+    # --- State --------------------------------------------------------------------------------
+
+    def transition(self, event):
+        """Applies event to the state machine. Returns False (and changes nothing) if it is not allowed now."""
+        with self.lock:
+            new_state = TRANSITIONS[event].get(self.state)
+            if new_state is None:
+                return False
+            self.state = new_state
+            return True
+
+    def snapshot(self):
+        """Consistent copy of the mission state, safe to call from any thread."""
+        with self.lock:
+            return {
+                "state": self.state,
+                "current_index": self.current_index,
+                "depths_and_times": self.depths_and_times,
+                "depths_source": self.depths_source,
+                "station_setpoint": self.station_setpoint,
+                "arrived": self.arrived_at is not None,
+                "sonar_depth_limit": self.sonar_depth_limit,
+                "mission_depth_limit": self.mission_depth_limit,
+            }
+
+    # --- Events -------------------------------------------------------------------------------
+
+    def on_init_sampling(self, value):
+        if value == 1 and self.transition("start"):
+            print("Switching to sampling state.")
+            self.send_udp("on")  # Notify server sampling has started
+            self.start_mission(0)
+        elif value == 0 and self.transition("stop"):
+            print("Switching to idle state.")
+            self.send_udp("stop")  # Notify server sampling has stopped
+            self.set_idle()
+
+    def on_sonar_depth(self, sonar_depth):
+        limit = sonar_depth - 2  # Apply 2-meter safety buffer
+        with self.lock:
+            self.sonar_depth_limit = limit
+            if self.state == "sampling":
+                if limit < self.mission_depth_limit:
+                    print(f"Sonar depth limit {limit} meters is shallower than the mission limit, clamping setpoints.")
+                    self.mission_depth_limit = limit
+                return
+        print(f"Updated sonar depth limit: {limit} meters")
+        if self.depths_source != "file":
+            self.generate_default_depths()
+
+    def on_winch_state(self, winch_state, position_m):
+        """Winch state report. The station is reached when the winch is idle within tolerance of the setpoint."""
+        if self.state != "sampling" or self.station_setpoint is None or self.arrived_at is not None:
+            return
+        if winch_state == "idle" and abs(position_m - self.station_setpoint) <= self.arrival_tolerance:
+            print(f"Winch arrived at {position_m} m (station {self.current_index}).")
+            self.start_dwell()
+
+    def on_probe_sample(self, fields):
+        """Probe values, used by the adaptive profile while the winch is at a station."""
+        if self.profile is not None and self.state == "sampling" and self.dwell_timer is not None:
+            self.profile.add_sample(fields)
+
+    # --- Mission ------------------------------------------------------------------------------
+
+    def set_depths(self, depths_and_times, source="file"):
+        """Sets the station list. Ignored while a mission runs. Returns True if it was set."""
+        with self.lock:
+            if self.state == "sampling":
+                print("Mission in progress, depth list not changed.")
+                return False
+            self.depths_and_times = tuple(tuple(item) for item in depths_and_times)
+            self.depths_source = source
+            return True
+
+    def generate_default_depths(self):
+        """Default profile: every 5 m down to the sonar depth limit, 10 minutes each."""
+        limit = self.sonar_depth_limit
+        if limit == float('inf'):
+            print("Sonar depth limit not set. Cannot generate default depths.")
+            return
+
+        depths_and_times = []
+        depth = 0
+        while depth + 5 <= limit:  # Increment by 5 meters
+            depths_and_times.append((depth, 10))  # Time is 10 minutes for each depth
+            depth += 5
+
+        if self.set_depths(depths_and_times, source="default"):
+            print(f"Generated default depths up to {limit} meters with a 2-meter safety buffer:")
+            print(list(self.depths_and_times))
+
+    def start_mission(self, index):
+        with self.lock:
+            self.current_index = index
+            self.mission_depth_limit = self.sonar_depth_limit
+        if self.profile is not None:
+            self.profile.begin_mission()
+        self.start_station()
+
+    def start_station(self):
+        self.cancel_timers()
+        if self.state != "sampling":
+            return
+        if self.current_index >= len(self.depths_and_times):
+            self.finish()
+            return
+
+        with self.lock:
+            depth, time_in_min = self.depths_and_times[self.current_index]
+            safe_depth = min(depth, self.mission_depth_limit)
+            self.station_setpoint = safe_depth
+            self.published_at = self.clock()
+            self.arrived_at = None
+        safe_depth_cm = int(safe_depth * 100)  # Convert meters to centimeters
+        print(f"Publishing depth {safe_depth_cm} cm (index {self.current_index}).")
+        self.publish_setpoint(safe_depth_cm)
+        self.save_progress()
+
+        # The dwell starts when the winch reports arrival, or after the arrival timeout
+        self.arrival_timer = self.scheduler.call_later(self.arrival_timeout, self.on_arrival_timeout)
+
+    def start_dwell(self):
+        self.scheduler.cancel(self.arrival_timer)
+        self.arrival_timer = None
+        with self.lock:
+            self.arrived_at = self.clock()
+        time_in_min = self.depths_and_times[self.current_index][1]
+        if self.profile is not None:
+            time_in_min = self.profile.dwell_min(time_in_min)
+            self.profile.start_dwell(self.station_setpoint)
+        print(f"Sampling at station {self.current_index} for {time_in_min} min.")
+        self.dwell_timer = self.scheduler.call_later(time_in_min * 60, self.on_dwell_done)
+
+    def on_arrival_timeout(self):
+        self.arrival_timer = None
+        if self.state == "sampling" and self.arrived_at is None:
+            print(f"No winch arrival report for station {self.current_index}, starting the dwell anyway.")
+            self.start_dwell()
+
+    def on_dwell_done(self):
+        self.dwell_timer = None
+        if self.state != "sampling" or self.arrived_at is None:
+            return
+        finished_at = self.clock()
+        report = {
+            "index": self.current_index,
+            "depth": self.station_setpoint,
+            "travel": round(self.arrived_at - self.published_at, 1),  # s from setpoint to arrival
+            "dwell": round(finished_at - self.arrived_at, 1),         # s sampled at depth
+        }
+        with self.lock:
+            if self.profile is not None:
+                self.depths_and_times = tuple(self.profile.finish_station(self.current_index,
+                                                                          list(self.depths_and_times)))
+            self.current_index += 1
+        self.start_station()  # Publish the next setpoint first so the move overlaps the station_done work
+        if self.station_done is not None:
+            self.station_done(report)
+
+    def finish(self):
+        # All depths are processed; enter waiting state
+        if not self.transition("finish"):
+            return
+        print("All depths processed. Entering waiting state. Sending setpoint 0.")
+        self.end_mission()
+
+    def set_idle(self):
+        """Stops any mission and parks the winch. Also used at startup to publish the idle setpoint once."""
+        self.transition("stop")
+        print("Idle state: Publishing depth 0 cm.")
+        self.end_mission()
+
+    def end_mission(self):
+        self.cancel_timers()
+        with self.lock:
+            self.station_setpoint = None
+            self.arrived_at = None
+        self.publish_setpoint(0)
+        self.save_progress()
+        # Sonar updates that arrived during the mission apply from now on
+        if self.depths_source == "default":
+            self.generate_default_depths()
+
+    def cancel_timers(self):
+        self.scheduler.cancel(self.dwell_timer)
+        self.scheduler.cancel(self.arrival_timer)
+        self.dwell_timer = self.arrival_timer = None
+
+    # --- Persistence --------------------------------------------------------------------------
+
+    def save_progress(self):
+        if not self.progress_file:
+            return
+        snapshot = self.snapshot()
+        progress = {
+            "state": snapshot["state"],
+            "current_index": snapshot["current_index"],
+            "depths_and_times": snapshot["depths_and_times"],
+            "depths_source": snapshot["depths_source"],
+            "saved_at": time.time(),
+        }
+        try:
+            temporary = self.progress_file + ".tmp"
+            with open(temporary, 'w') as file:
+                json.dump(progress, file)
+            os.replace(temporary, self.progress_file)  # Atomic, a crash never leaves half a file
+        except OSError as e:
+            print(f"Could not save mission progress: {e}")
+
+    def resume(self):
+        """Continues a mission that was in progress when the coordinator stopped. Returns True if one was resumed."""
+        if not self.progress_file:
+            return False
+        try:
+            with open(self.progress_file, 'r') as file:
+                progress = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if progress.get("state") != "sampling" or not self.set_depths(progress["depths_and_times"],
+                                                                      progress.get("depths_source", "file")):
+            return False
+        print(f"Resuming mission at station {progress['current_index']} of {len(self.depths_and_times)}.")
+        self.transition("start")
+        self.start_mission(progress["current_index"])
+        return True
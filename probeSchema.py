@@ -0,0 +1,171 @@
+#
+# Probe packet schema shared by UDPtoMQTT, MQTTtoLOG and the debug senders.
+# The packet layouts are described in probe_schema.json and compiled once into a parser,
+# so a new probe firmware layout only needs a schema change.
+#
+# Run this file directly to measure the per-packet parsing cost.
+#
+
+import json
+import math
+import os
+import random
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'probe_schema.json')
+
+def number(value):
+    """int for an integer value like "123", float otherwise, so counters are published as they were sent."""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+# Converters for the "type" of a field (float() and int() ignore surrounding whitespace themselves)
+FIELD_TYPES = {
+    "float": float,
+    "int": int,
+    "number": number,
+    "str": str.strip,
+}
+
+# Operations available for derived fields, applied to the converted values of "args"
+DERIVED_OPS = {
+    "absdiff": lambda a, b: abs(a - b),
+    "diff": lambda a, b: a - b,
+    "sum": lambda *args: sum(args),
+    "mean": lambda *args: sum(args) / len(args),
+}
+
+class PacketError(ValueError):
+    """Raised when a packet does not match the schema."""
+
+class Layout:
+    """One compiled packet layout, selected by the number of comma separated values."""
+
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.fields = spec["fields"]
+        self.derived = spec.get("derived", [])
+        self.names = tuple(field["name"] for field in self.fields)
+        self.size = len(self.names)
+        self.units = {field["name"]: field.get("unit", "") for field in self.fields + self.derived}
+
+        try:
+            converters = [FIELD_TYPES[field.get("type", "float")] for field in self.fields]
+            # Derived fields are resolved to (name, function, argument indexes) once, here
+            self.derived_steps = tuple(
+                (item["name"], DERIVED_OPS[item["op"]], tuple(self.names.index(arg) for arg in item["args"]))
+                for item in self.derived
+            )
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"Invalid schema for layout '{self.name}': {e}")
+
+        # Most layouts are all floats, map() over the values is then the cheapest conversion
+        self.all_float = all(conv is float for conv in converters)
+        self.converters = tuple(converters)
+
+    def parse(self, values):
+        """Converts a list of string values to a dict of field name -> number, derived fields included."""
+        try:
+            if self.all_float:
+                converted = list(map(float, values))
+                numbers = converted
+            else:
+                converted = [conv(value) for conv, value in zip(self.converters, values)]
+                numbers = [value for value in converted if isinstance(value, float)]
+        except ValueError as e:
+            raise PacketError(f"Invalid value in '{self.name}' packet: {e}")
+        # float() accepts "nan" and "inf", which are not valid JSON and not a measurement
+        if not all(map(math.isfinite, numbers)):
+            raise PacketError(f"Non-finite value in '{self.name}' packet: {','.join(values)}")
+
+        fields = dict(zip(self.names, converted))
+        for name, op, indexes in self.derived_steps:
+            fields[name] = op(*[converted[i] for i in indexes])
+        return fields
+
+    def format(self, fields):
+        """Builds the packet text the probe would send for these field values."""
+        return ",".join(str(fields[name]) for name in self.names)
+
+    def simulate(self):
+        """Random field values within the "sim" range of each field, for the debug senders."""
+        fields = {}
+        for field in self.fields:
+            low, high = field.get("sim", (0, 1))
+            if field.get("type", "float") in ("int", "number"):
+                fields[field["name"]] = random.randint(int(low), int(high))
+            else:
+                fields[field["name"]] = round(random.uniform(low, high), 2)
+        return fields
+
+class ProbeSchema:
+    """All packet layouts and keyword messages of the probe."""
+
+    def __init__(self, spec):
+        self.layouts = [Layout(layout) for layout in spec["layouts"]]
+        self.by_size = {}
+        for layout in self.layouts:
+            if layout.size in self.by_size:
+                raise ValueError(f"Layouts '{self.by_size[layout.size].name}' and '{layout.name}' have the same number of fields")
+            self.by_size[layout.size] = layout
+        self.by_name = {layout.name: layout for layout in self.layouts}
+        self.keywords = spec.get("keywords", [])
+
+    def field_names(self):
+        """All field names over all layouts, in schema order, derived fields last."""
+        names = []
+        for layout in self.layouts:
+            for name in list(layout.names) + [item["name"] for item in layout.derived]:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def units(self):
+        units = {}
+        for layout in self.layouts:
+            for name, unit in layout.units.items():
+                units.setdefault(name, unit)
+        return units
+
+    def storage_formats(self):
+        """struct codes for the binary log, for fields that need more than the default float32."""
+        formats = {}
+        for layout in self.layouts:
+            for field in layout.fields + layout.derived:
+                if "storage" in field:
+                    formats.setdefault(field["name"], field["storage"])
+        return formats
+
+    def parse(self, data):
+        """
+        Parses one packet. Returns (layout name, fields) for a data packet,
+        ("keyword", {topic: value}) for a keyword message like 'leak', and raises PacketError otherwise.
+        """
+        values = data.split(',')
+        layout = self.by_size.get(len(values))
+        if layout is not None:
+            return layout.name, layout.parse(values)
+
+        for keyword in self.keywords:
+            if keyword["match"] in data:
+                return "keyword", {keyword["topic"]: keyword["value"]}
+
+        raise PacketError(f"Unknown packet format with {len(values)} values")
+
+def load_schema(path=SCHEMA_FILE):
+    """Loads and compiles the schema. Call once at startup."""
+    with open(path, 'r') as file:
+        return ProbeSchema(json.load(file))
+
+def benchmark(count=100000):
+    """Measures the per-packet parsing cost of every layout."""
+    import timeit
+    schema = load_schema()
+    for layout in schema.layouts:
+        packet = layout.format(layout.simulate())
+        seconds = timeit.timeit(lambda: schema.parse(packet), number=count)
+        print(f"{layout.name:>8} ({layout.size} fields): {seconds / count * 1e6:.2f} us per packet")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,91 @@
+#
+# Per-topic publish policy: only let meaningful updates through to the MQTT broker.
+#
+# Each topic can have:
+#   max_rate - most publishes per second (0 = no limit). A change that comes too soon is held
+#              back and published by due() once the topic is allowed to publish again.
+#   min_rate - least publishes per second (0 = none). The last value is republished as a
+#              heartbeat when nothing was published for 1/min_rate seconds.
+#   deadband - numeric values are only published when they differ from the last published
+#              value by more than this. Other values are published when they change.
+#
+
+import time
+
+DEFAULT_POLICY = {"max_rate": 0, "min_rate": 0, "deadband": 0}
+
+class TopicState:
+    __slots__ = ("value", "published_at", "pending")
+
+    def __init__(self):
+        self.value = None         # Last published value
+        self.published_at = None  # When it was published
+        self.pending = None       # Changed value held back by max_rate, wrapped in a tuple so None is a valid value
+
+class PublishPolicy:
+    """Decides per topic whether a new value is worth publishing."""
+
+    def __init__(self, policies, default=None, clock=time.monotonic):
+        self.default = dict(DEFAULT_POLICY, **(default or {}))
+        self.policies = {topic: dict(self.default, **policy) for topic, policy in policies.items()}
+        self.clock = clock
+        self.states = {}
+
+    def policy(self, topic):
+        return self.policies.get(topic, self.default)
+
+    def changed(self, topic, old, new):
+        if old is None:
+            return True
+        deadband = self.policy(topic)["deadband"]
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)):
+            return abs(new - old) > deadband
+        return new != old
+
+    def should_publish(self, topic, value, now=None):
+        """Call with every new value. Returns True if it should be published now (and records it as published)."""
+        now = self.clock() if now is None else now
+        state = self.states.get(topic)
+        if state is None:
+            state = self.states[topic] = TopicState()
+
+        if state.published_at is not None and not self.changed(topic, state.value, value):
+            state.pending = None  # Back within the deadband of what subscribers already have
+            return False
+
+        max_rate = self.policy(topic)["max_rate"]
+        if state.published_at is not None and max_rate and now - state.published_at < 1.0 / max_rate:
+            state.pending = (value,)
+            return False
+
+        self.mark_published(state, value, now)
+        return True
+
+    def due(self, now=None):
+        """Returns (topic, value) pairs that should be published now: held back changes and heartbeats."""
+        now = self.clock() if now is None else now
+        result = []
+        for topic, state in self.states.items():
+            if state.published_at is None:
+                continue
+            policy = self.policy(topic)
+            elapsed = now - state.published_at
+            if state.pending is not None:
+                if not policy["max_rate"] or elapsed >= 1.0 / policy["max_rate"]:
+                    value = state.pending[0]
+                    self.mark_published(state, value, now)
+                    result.append((topic, value))
+            elif policy["min_rate"] and elapsed >= 1.0 / policy["min_rate"]:
+                self.mark_published(state, state.value, now)
+                result.append((topic, state.value))
+        return result
+
+    def last_value(self, topic):
+        state = self.states.get(topic)
+        return state.value if state else None
+
+    @staticmethod
+    def mark_published(state, value, now):
+        state.value = value
+        state.published_at = now
+        state.pending = None
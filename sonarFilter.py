@@ -0,0 +1,83 @@
+#
+# Filtering of the Ping1D depth readings before they are used as the depth limit.
+#
+# Each reading goes through:
+#   1. a confidence gate - readings below min_confidence are rejected
+#   2. a median over the last `window` accepted readings - single bad pings are ignored
+#   3. an EMA - smooths what is left of the ping-to-ping noise
+#   4. a rate-of-change limit - the output moves at most max_rate m/s, the bottom cannot jump
+#
+# Every update returns the filtered depth with a quality flag:
+#   "good"     - enough recent accepted readings
+#   "settling" - accepted readings, but fewer than min_samples so far
+#   "hold"     - the latest reading was rejected, the last good depth is repeated (up to max_hold s)
+#   "invalid"  - no accepted reading for max_hold s, depth is None
+#
+
+import time
+
+GOOD = "good"
+SETTLING = "settling"
+HOLD = "hold"
+INVALID = "invalid"
+
+class SonarFilter:
+    """Median/EMA filter with confidence gating and rate limiting. Depths are in metres."""
+
+    def __init__(self, window=7, min_confidence=80, max_rate=1.0, ema_alpha=0.3, min_samples=3,
+                 max_hold=10.0, clock=time.monotonic):
+        self.window = window
+        self.min_confidence = min_confidence  # %
+        self.max_rate = max_rate              # m/s
+        self.ema_alpha = ema_alpha
+        self.min_samples = min_samples
+        self.max_hold = max_hold              # s
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.samples = []      # Last `window` accepted readings, oldest first
+        self.depth = None      # Filtered depth
+        self.updated_at = None
+        self.accepted_at = None
+
+    def update(self, distance, confidence, now=None):
+        """Adds a reading (m, %). Returns (filtered depth or None, quality)."""
+        now = self.clock() if now is None else now
+
+        if confidence < self.min_confidence or distance <= 0:
+            if self.accepted_at is not None and now - self.accepted_at <= self.max_hold:
+                return self.depth, HOLD
+            self.reset()
+            return None, INVALID
+
+        if self.accepted_at is not None and now - self.accepted_at > self.max_hold:
+            self.reset()  # Too old to limit the rate against, start over
+        self.accepted_at = now
+
+        self.samples.append(distance)
+        if len(self.samples) > self.window:
+            del self.samples[0]
+        median = sorted(self.samples)[len(self.samples) // 2]
+
+        if self.depth is None:
+            self.depth = median
+        else:
+            smoothed = self.depth + self.ema_alpha * (median - self.depth)
+            step = self.max_rate * (now - self.updated_at)
+            self.depth = max(self.depth - step, min(self.depth + step, smoothed))
+        self.updated_at = now
+
+        return self.depth, GOOD if len(self.samples) >= self.min_samples else SETTLING
+
+def salinity_from_conductivity(conductivity):
+    """Rough practical salinity (PSU) from conductivity in uS/cm, good enough for the speed of sound."""
+    if conductivity <= 0:
+        return 0.0
+    return 0.4665 * (conductivity / 1000) ** 1.0878
+
+def speed_of_sound(temperature, salinity=0.0, depth=0.0):
+    """Speed of sound in water in m/s (Medwin 1975), temperature in degC, salinity in PSU, depth in m."""
+    t = temperature
+    return (1449.2 + 4.6 * t - 0.055 * t ** 2 + 0.00029 * t ** 3
+            + (1.34 - 0.01 * t) * (salinity - 35) + 0.016 * depth)
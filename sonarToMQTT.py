@@ -1,14 +1,57 @@
-#this script read the Blue Robotics ping 1d and sende the data to the MQTT broker. 
+#this script read the Blue Robotics ping 1d and sende the data to the MQTT broker.
 
-from brping import Ping1D
+from brping import Ping1D, definitions
+import threading
 import time
 import paho.mqtt.client as mqtt
+from messageBus import json_payload
+from sonarFilter import SonarFilter, salinity_from_conductivity, speed_of_sound
 
 # Hardcoded settings
 DEVICE_PORT = '/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_AB0JJR9I-if00-port0'
 BAUDRATE = 115200
 MQTT_BROKER = '127.0.0.1'  # MQTT broker address
 
+# Topics: the raw distance in mm as read, and the filtered depth in m with a quality flag
+RAW_TOPIC = "platform/sonarDepth"
+FILTERED_TOPIC = "platform/sonarDepthFiltered"
+
+# Acquisition mode:
+#   "stream" - the Ping1D sends distance messages by itself at its own ping rate, no polling
+#   "poll"   - request a distance every SAMPLE_INTERVAL seconds
+ACQUISITION_MODE = "stream"
+SAMPLE_INTERVAL = 0.2    # s between readings in "poll" mode
+PING_INTERVAL_MS = None  # ms between pings in "stream" mode, None keeps the device setting
+STREAM_TIMEOUT = 2.0     # s without a streamed message before streaming is restarted
+PUBLISH_DECIMATION = 1   # Publish every Nth reading, the filter still sees all of them
+
+# Filter settings (see sonarFilter.py)
+FILTER_WINDOW = 7        # readings in the median window
+MIN_CONFIDENCE = 80      # %, readings below this are rejected
+MAX_DEPTH_RATE = 1.0     # m/s, fastest the filtered depth may change
+EMA_ALPHA = 0.3          # smoothing of the median, 1 = none
+MAX_HOLD = 10.0          # s to repeat the last good depth while readings are rejected
+
+# Speed of sound: fixed, or derived from the probe's water temperature and conductivity
+SPEED_OF_SOUND = 1450000          # mm/s, used until (or instead of) probe data
+SPEED_FROM_PROBE = True           # Follow probe/T_ude and probe/EC when they are published
+SPEED_UPDATE_INTERVAL = 60        # s, shortest time between speed of sound changes on the sonar
+SPEED_DEADBAND = 2000             # mm/s, smaller changes are not sent to the sonar
+SPEED_LIMITS = (1400000, 1600000) # mm/s, probe derived values outside this range are ignored
+TEMPERATURE_TOPIC = "probe/T_ude"
+CONDUCTIVITY_TOPIC = "probe/EC"
+
+# Latest probe values, written by the MQTT thread and read by the sonar loop
+probe_temperature = None
+probe_conductivity = None
+
+# Set up in main()
+myPing = None
+mqtt_client = None
+sonar_filter = None
+current_speed = SPEED_OF_SOUND
+speed_updated_at = 0.0
+
 # Function to connect to the MQTT broker
 def connect_mqtt():
     while True:
@@ -21,42 +64,136 @@ def connect_mqtt():
             print(f"Failed to connect to MQTT broker: {e}. Retrying in 5 seconds...")
             time.sleep(5)
 
-# Make a new Ping
-myPing = Ping1D()
-myPing.connect_serial(DEVICE_PORT, BAUDRATE)
+def on_connect(client, userdata, flags, rc):
+    if SPEED_FROM_PROBE:
+        client.subscribe([(TEMPERATURE_TOPIC, 0), (CONDUCTIVITY_TOPIC, 0)])
 
-if myPing.initialize() is False:
-    print("Failed to initialize Ping!")
-    exit(1)
+def on_message(client, userdata, message):
+    global probe_temperature, probe_conductivity
+    try:
+        value = float(message.payload.decode())
+    except ValueError:
+        return
+    if message.topic == TEMPERATURE_TOPIC:
+        probe_temperature = value
+    elif message.topic == CONDUCTIVITY_TOPIC:
+        probe_conductivity = value
 
-myPing.set_speed_of_sound(1450000) #for more accrute mesurement change this to match the medium [mm/s]
-# Initialize MQTT client
-mqtt_client = mqtt.Client()
+# Speed of sound for the current probe readings in mm/s, None if there are none or it is implausible
+def probe_speed_of_sound():
+    temperature = probe_temperature
+    if temperature is None:
+        return None
+    salinity = salinity_from_conductivity(probe_conductivity) if probe_conductivity is not None else 0.0
+    speed = int(speed_of_sound(temperature, salinity) * 1000)  # m/s to mm/s
+    if not SPEED_LIMITS[0] <= speed <= SPEED_LIMITS[1]:
+        return None
+    return speed
 
-# Connect to the MQTT broker with retry
-connect_mqtt()
+# Send a new speed of sound to the sonar when the probe readings have changed it enough
+def update_speed_of_sound(now):
+    global current_speed, speed_updated_at
+    if not SPEED_FROM_PROBE or now - speed_updated_at < SPEED_UPDATE_INTERVAL:
+        return
+    speed_updated_at = now
+    speed = probe_speed_of_sound()
+    if speed is None or abs(speed - current_speed) < SPEED_DEADBAND:
+        return
+    if myPing.set_speed_of_sound(speed):
+        print(f"Speed of sound set to {speed} mm/s (T_ude {probe_temperature} degC, EC {probe_conductivity} uS/cm)")
+        current_speed = speed
 
-print("------------------------------------")
-print("Starting Ping...")
-print("------------------------------------")
+# Start (or restart) the device sending distance messages continuously
+def start_streaming():
+    if PING_INTERVAL_MS is not None:
+        myPing.set_ping_interval(PING_INTERVAL_MS)
+    myPing.control_continuous_start(definitions.PING1D_DISTANCE)
 
-# Read and print distance measurements with confidence
-try:
-    while True:
-        data = myPing.get_distance()
-        if data:
-            distance = data["distance"]
-            confidence = data["confidence"]
-            print("Distance: %s\tConfidence: %s%%" % (distance, confidence))
-            
-            # Publish the depth to the MQTT topic
-            mqtt_client.publish("platform/sonarDepth", distance)
-        else:
-            print("Failed to get distance data")
-        
-        time.sleep(5)
-except KeyboardInterrupt:
-    print("Exiting...")
-finally:
-    mqtt_client.loop_stop()  # Stop the loop
-    mqtt_client.disconnect()
+# Yields (distance [mm], confidence [%]) readings, None when a reading failed, until stop_event is set
+def readings(stop_event):
+    if ACQUISITION_MODE == "stream":
+        start_streaming()
+        last_message = time.monotonic()
+        while not stop_event.is_set():
+            message = myPing.wait_message([definitions.PING1D_DISTANCE], timeout=0.5)
+            now = time.monotonic()
+            if message is not None:
+                last_message = now
+                yield message.distance, message.confidence
+            elif now - last_message > STREAM_TIMEOUT:
+                print("No distance messages from the Ping, restarting streaming")
+                last_message = now
+                start_streaming()
+                yield None
+    else:
+        while not stop_event.is_set():
+            data = myPing.get_distance()
+            yield (data["distance"], data["confidence"]) if data else None
+            time.sleep(SAMPLE_INTERVAL)
+
+def main(shared_client=None, stop_event=None):
+    """Runs until interrupted, or until stop_event is set. master.py passes a shared client in single-process mode."""
+    global myPing, current_speed, speed_updated_at, sonar_filter, mqtt_client
+    stop_event = stop_event or threading.Event()
+
+    # Make a new Ping
+    myPing = Ping1D()
+    myPing.connect_serial(DEVICE_PORT, BAUDRATE)
+
+    if myPing.initialize() is False:
+        print("Failed to initialize Ping!")
+        return 1
+
+    myPing.set_speed_of_sound(SPEED_OF_SOUND) #for more accrute mesurement change this to match the medium [mm/s]
+    current_speed = SPEED_OF_SOUND
+    speed_updated_at = time.monotonic()
+
+    sonar_filter = SonarFilter(window=FILTER_WINDOW, min_confidence=MIN_CONFIDENCE, max_rate=MAX_DEPTH_RATE,
+                               ema_alpha=EMA_ALPHA, max_hold=MAX_HOLD)
+
+    # Initialize MQTT client
+    mqtt_client = shared_client or mqtt.Client()
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_message = on_message
+
+    # Connect to the MQTT broker with retry
+    connect_mqtt()
+
+    print("------------------------------------")
+    print("Starting Ping...")
+    print("------------------------------------")
+
+    # Read distance measurements with confidence, filter all of them and publish every PUBLISH_DECIMATION-th
+    try:
+        count = 0
+        for reading in readings(stop_event):
+            update_speed_of_sound(time.monotonic())
+            if reading is None:
+                print("Failed to get distance data")
+                continue
+
+            distance, confidence = reading
+            depth, quality = sonar_filter.update(distance / 1000, confidence)  # mm to m
+            count += 1
+            if count % PUBLISH_DECIMATION:
+                continue
+            print("Distance: %s\tConfidence: %s%%\tFiltered: %s m (%s)" % (distance, confidence, depth, quality))
+
+            # Publish the raw distance and the filtered depth to the MQTT topics
+            mqtt_client.publish(RAW_TOPIC, distance)
+            mqtt_client.publish(FILTERED_TOPIC, json_payload(mqtt_client, {
+                "depth": round(depth, 2) if depth is not None else None,
+                "quality": quality,
+                "confidence": confidence,
+            }))
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        if ACQUISITION_MODE == "stream":
+            myPing.control_continuous_stop(definitions.PING1D_DISTANCE)
+        mqtt_client.loop_stop()  # Stop the loop
+        mqtt_client.disconnect()
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,65 @@
+#
+# Staleness watchdog: notices topics that stop updating.
+#
+# Each watched topic has a timeout. Receiving a message only stores its time (O(1), no heap work),
+# the heap holds at most one deadline per topic. When a deadline comes up, the topic's real deadline
+# (last seen + timeout) is checked: if it has moved on the entry is pushed again, otherwise the topic
+# is stale. This keeps the cost per message constant and the cost per check O(log n), so hundreds of
+# topics can be watched from one timer.
+#
+
+import heapq
+import threading
+import time
+
+class TopicWatchdog:
+    """Tracks last-seen times for topics with a timeout each (seconds). Thread-safe."""
+
+    def __init__(self, timeouts, clock=time.monotonic):
+        self.timeouts = dict(timeouts)
+        self.clock = clock
+        self.lock = threading.Lock()
+        now = clock()
+        # Topics that have not been seen yet count from startup
+        self.last_seen = {topic: now for topic in self.timeouts}
+        self.stale = set()
+        self.heap = [(now + timeout, topic) for topic, timeout in self.timeouts.items()]
+        heapq.heapify(self.heap)
+
+    def seen(self, topic, now=None):
+        """Call for every message on a watched topic. Returns True if the topic was stale and has recovered."""
+        if topic not in self.last_seen:
+            return False
+        now = self.clock() if now is None else now
+        with self.lock:
+            self.last_seen[topic] = now
+            if topic in self.stale:
+                self.stale.discard(topic)
+                heapq.heappush(self.heap, (now + self.timeouts[topic], topic))
+                return True
+            return False
+
+    def check(self, now=None):
+        """Returns the topics that became stale since the last check."""
+        now = self.clock() if now is None else now
+        became_stale = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, topic = heapq.heappop(self.heap)
+                deadline = self.last_seen[topic] + self.timeouts[topic]
+                if deadline > now:
+                    heapq.heappush(self.heap, (deadline, topic))  # Seen since, wait for the new deadline
+                else:
+                    self.stale.add(topic)  # No heap entry until it is seen again
+                    became_stale.append(topic)
+        return became_stale
+
+    def next_deadline(self):
+        """Earliest time check() can find a stale topic, None if every topic is already stale."""
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def age(self, topic, now=None):
+        """Seconds since the topic was last seen (or since startup)."""
+        now = self.clock() if now is None else now
+        return now - self.last_seen[topic]
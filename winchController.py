@@ -3,24 +3,45 @@
 #on startup the script homes the winch and then starts controling based on asetpoint recived over MQTT
 #
 
+import json
+import threading
 import paho.mqtt.client as mqtt
 from gpiozero import PWMOutputDevice, DigitalOutputDevice, DigitalInputDevice
 from gpiozero.pins.pigpio import PiGPIOFactory
+import pigpio
 import time
+from winchEncoder import QuadratureEncoder
+import winchMotion
+from winchMotion import MotionController, MotionWorker
 
 # Pin Definitions
 PWM_PIN = 13         # PWM pin for speed control
 DIR_PIN = 6          # Direction pin
 HALL_EFFECT_PIN = 10 # Hall effect sensor pin
 ENCODER_A_PIN = 8    # Encoder A channel pin
-bounce_time = 0.005
-P_factor = 0.02 
+ENCODER_B_PIN = None # Encoder B channel pin, set it when channel B is wired to enable quadrature decoding
+ENCODER_GLITCH_US = 100  # Edges shorter than this (microseconds) are filtered out by pigpiod
+P_factor = 0.02           # Proportional gain of the position controller (duty per cm of error)
+I_factor = 0.0            # Integral gain (duty per cm*s)
+D_factor = 0.0            # Derivative gain (duty per cm/s)
 
 # Motor and Encoder Configuration
 invert_direction = True    # Set to True to invert the motor direction
 PWM_FREQUENCY = 5000      # Set desired PWM frequency in Hz
-MOTOR_SPEED = 0.5         # Normal motor speed (0.0 to 1.0)
+MOTOR_SPEED = 0.5         # Normal motor speed (0.0 to 1.0), the largest duty used by moves
 HOMING_SPEED = 0.5        # Slower speed for homing (0.0 to 1.0)
+HOMING_FINAL_SPEED = 0.25 # Speed of the last part of homing after a fast approach (0.0 to 1.0)
+HOME_APPROACH_CM = 20.0   # When the position is known, move at full speed up to here before the final approach
+HOME_TOLERANCE_CM = 2.0   # Homing is skipped when the end-stop is active and the position is within this of 0
+
+# Motion control (see winchMotion.py)
+MAX_VELOCITY = 15.0         # Cruise speed of a move in cm/s
+MAX_ACCELERATION = 10.0     # Acceleration/deceleration in cm/s^2
+VELOCITY_PER_DUTY = 40.0    # Winch speed in cm/s at duty 1.0, used as feedforward (calibrate on the boat)
+MIN_DUTY = 0.1              # Smallest duty that still turns the motor
+CONTROL_RATE_HZ = 50        # Control loop rate
+POSITION_TOLERANCE = 1.0    # A move is done within this many cm of the target
+STALL_TIMEOUT = 0.5         # Seconds of driving without encoder pulses before the move is aborted
 
 # Encoder Specifications
 PULSES_PER_REVOLUTION = 100  # Encoder PPR
@@ -30,6 +51,10 @@ DISTANCE_PER_PULSE = 0.2638  # Distance per encoder pulse in cm
 mqtt_broker = '127.0.0.1'
 mqtt_topic = 'platform/winchSetPoint'
 status_topic = 'platform/winchCurrentPos'
+state_topic = 'platform/winchState'
+home_drift_topic = 'platform/winchHomeDrift'
+STATE_RATE_HZ = 5           # State messages per second while the winch is moving or homing
+STATE_IDLE_INTERVAL = 5     # Seconds between state messages at rest
 RECONNECT_ATTEMPTS = 5      # Max number of reconnect attempts
 
 # Define the pin factory using pigpio
@@ -40,55 +65,137 @@ pwm_motor = PWMOutputDevice(PWM_PIN, frequency=PWM_FREQUENCY, pin_factory=pin_fa
 direction_pin = DigitalOutputDevice(DIR_PIN, pin_factory=pin_factory)
 hall_effect_sensor = DigitalInputDevice(HALL_EFFECT_PIN, pull_up=True, pin_factory=pin_factory)
 
-# Initialize encoder channel A only
-encoder_a = DigitalInputDevice(ENCODER_A_PIN, pull_up=False, bounce_time=bounce_time, pin_factory=pin_factory)
-
 # Encoder state
-position_pulses = 0
 current_direction = 'up'  # Track current motor direction
+homed = False             # Position is only known after the first successful homing
+winch_state = 'idle'      # 'idle', 'moving' or 'homing'
+target_cm = None          # Target of the current move
+motor_duty = 0.0          # Signed duty last set on the motor, positive is down
+hall_trip_position = None # Encoder position when the home sensor last tripped
 
-def encoder_callback():
-    global position_pulses, current_direction
-    
-    # Increment or decrement based on current motor direction
-    if current_direction == 'down':
-        position_pulses += 1
-    else:  # direction is 'up'
-        position_pulses -= 1
+# Home offset drift: encoder position found at the home sensor on re-homing (should be close to 0)
+home_stats = {"count": 0, "skipped": 0, "last_drift_cm": None, "max_drift_cm": 0.0, "mean_abs_drift_cm": 0.0}
 
-# Only attach to rising edge (when_activated)
-encoder_a.when_activated = encoder_callback
+# Winch commands, executed by the motion worker thread
+HOME = ("home",)
+worker = None
 
-def get_position_cm():
-    """Calculates the current position in cm from pulses."""
-    return position_pulses * DISTANCE_PER_PULSE
+def motor_direction():
+    """Direction for single channel counting: +1 when moving down (cable out), -1 when moving up."""
+    return 1 if current_direction == 'down' else -1
 
-def home_motor(client):
-    """Moves the motor 'up' to the home position using the hall effect sensor."""
-    print("Homing motor...")
-    global current_direction
-    
-    current_direction = 'up'
-    if invert_direction:
-        direction_pin.off()
-    else:
-        direction_pin.on()
-    
-    pwm_motor.value = HOMING_SPEED  # Use homing speed
+# Encoder edges are timestamped by pigpiod, using the same pigpio connection as gpiozero
+encoder = QuadratureEncoder(pin_factory.connection, ENCODER_A_PIN, ENCODER_B_PIN,
+                            distance_per_pulse=DISTANCE_PER_PULSE, direction_source=motor_direction,
+                            glitch_us=ENCODER_GLITCH_US, pull=pigpio.PUD_DOWN)
 
-    while not hall_effect_sensor.is_active:
-        time.sleep(0.01)
+def get_position_cm():
+    """Current position in cm from the encoder."""
+    return encoder.position()
+
+def get_velocity_cm_s():
+    """Current velocity in cm/s from the encoder, positive when moving down."""
+    return encoder.velocity()
+
+def set_motor(duty):
+    """Drives the motor with a signed duty: positive moves down (cable out), negative moves up, 0 stops."""
+    global current_direction, motor_duty
+    motor_duty = duty
+    if duty == 0:
+        pwm_motor.off()
+        return
+    if duty > 0:
+        current_direction = 'down'
+        direction_pin.on() if invert_direction else direction_pin.off()
+    else:
+        current_direction = 'up'
+        direction_pin.off() if invert_direction else direction_pin.on()
+    pwm_motor.value = min(abs(duty), 1.0)
+
+motion = MotionController(
+    get_position=get_position_cm,
+    set_output=set_motor,
+    at_endstop=lambda: hall_effect_sensor.is_active,
+    max_velocity=MAX_VELOCITY,
+    max_acceleration=MAX_ACCELERATION,
+    velocity_per_duty=VELOCITY_PER_DUTY,
+    kp=P_factor, ki=I_factor, kd=D_factor,
+    max_duty=MOTOR_SPEED,
+    min_duty=MIN_DUTY,
+    control_rate_hz=CONTROL_RATE_HZ,
+    tolerance=POSITION_TOLERANCE,
+    stall_timeout=STALL_TIMEOUT,
+)
+
+def on_home_sensor():
+    """Records the encoder position at the moment the hall effect sensor trips."""
+    global hall_trip_position
+    hall_trip_position = get_position_cm()
+
+hall_effect_sensor.when_activated = on_home_sensor
+
+def record_home_drift(client, drift_cm):
+    """Keeps statistics of the encoder position found at the home sensor and publishes them."""
+    home_stats["count"] += 1
+    home_stats["last_drift_cm"] = round(drift_cm, 2)
+    home_stats["max_drift_cm"] = round(max(home_stats["max_drift_cm"], abs(drift_cm)), 2)
+    home_stats["mean_abs_drift_cm"] = round(
+        (home_stats["mean_abs_drift_cm"] * (home_stats["count"] - 1) + abs(drift_cm)) / home_stats["count"], 3)
+    print(f"Home offset drift: {drift_cm:.2f} cm")
+    client.publish(home_drift_topic, json.dumps(home_stats, separators=(',', ':')))
+
+def home_motor(client, should_stop=None):
+    """
+    Moves the motor 'up' to the home position using the hall effect sensor. Returns True when homed.
+    If the position is known the winch first runs at full speed to HOME_APPROACH_CM and only the last
+    part is done at HOMING_FINAL_SPEED. Homing is skipped when the winch is already at home.
+    """
+    global homed, hall_trip_position
+
+    position = get_position_cm()
+    if homed and hall_effect_sensor.is_active and abs(position) <= HOME_TOLERANCE_CM:
+        home_stats["skipped"] += 1
+        client.publish(status_topic, (position / 100))
+        return True
 
-    pwm_motor.off()
-    global position_pulses
-    position_pulses = 0
+    print("Homing motor...")
+    hall_trip_position = None  # Only a trip during this homing counts, older ones are in the old encoder frame
+    speed = HOMING_SPEED
+    if homed and position > HOME_APPROACH_CM:
+        # Fast closed-loop move to just below home using the tracked position
+        result = motion.move_to(HOME_APPROACH_CM, should_stop)
+        if result == winchMotion.CANCELLED:
+            print("Homing cancelled by a new command.")
+            return False
+        if result == winchMotion.REACHED:
+            speed = HOMING_FINAL_SPEED
+        elif result != winchMotion.ENDSTOP:
+            print(f"Fast approach ended with '{result}', homing the slow way.")
+
+    if not hall_effect_sensor.is_active:
+        set_motor(-speed)  # Move up until the sensor trips
+        while not hall_effect_sensor.wait_for_active(timeout=0.05):
+            if should_stop is not None and should_stop():
+                set_motor(0)
+                print("Homing cancelled by a new command.")
+                return False
+        set_motor(0)
+    trip_position = hall_trip_position if hall_trip_position is not None else get_position_cm()
+    hall_trip_position = None
+
+    # The winch coasts a little past the sensor, home (0) is where the sensor tripped
+    if homed:
+        record_home_drift(client, trip_position)
+    encoder.reset(get_position_cm() - trip_position)
+    homed = True
     print("Motor homed to zero position.")
     client.publish(status_topic, (get_position_cm()/100))
+    return True
 
-def move_to_position(client, target_cm):
-    """Moves the motor to a specified position in cm."""
+def move_to_position(client, target_cm, should_stop=None):
+    """Moves the motor to a specified position in cm. A new command cancels the move through should_stop."""
     print(f"Moving to target position: {target_cm} cm")
-    global current_direction, position_pulses
+    global current_direction
 
     if target_cm < 0:
         print("Target position cannot be negative.")
@@ -96,73 +203,95 @@ def move_to_position(client, target_cm):
 
     current_position = get_position_cm()
 
-    # Determine direction based on target position
+    # Determine direction based on target position, platform/winchState carries it to the other scripts
     if target_cm > current_position:
         current_direction = 'down'  # Move down if target is greater than current
-        client.publish(status_topic, -2)
     else:
         current_direction = 'up'    # Move up if target is less than current
-        client.publish(status_topic, -1)
+    client.publish(status_topic, (current_position / 100))
 
     print(f"Current Position: {current_position} cm, Direction: {current_direction}")
 
-    # Set direction for motor movement
-    if current_direction == 'down':
-        direction_pin.on() if invert_direction else direction_pin.off()
-        pwm_motor.value = MOTOR_SPEED
-        print("Motor moving down")
-    elif current_direction == 'up':
-        if hall_effect_sensor.is_active:
-            print("End-stop reached. Motor will not run up.")
-            return
-        direction_pin.off() if invert_direction else direction_pin.on()
-        pwm_motor.value = MOTOR_SPEED
-        print("Motor moving up")
-
-    last_pulse_count = position_pulses
-    no_pulse_timeout = 0.5  # Timeout in seconds
-    timeout_start = time.time()
-
-    while (current_direction == 'down' and current_position < target_cm) or \
-          (current_direction == 'up' and current_position > target_cm):
-        current_position = get_position_cm()
-        print(f"Current Position: {current_position} cm")
-
-        # Check for encoder activity
-        if position_pulses != last_pulse_count:
-            last_pulse_count = position_pulses
-            timeout_start = time.time()  # Reset timeout if pulses change
-
-        if time.time() - timeout_start > no_pulse_timeout:
-            print("Encoder is not registering changes. Stopping motor and rehoming.")
-            pwm_motor.off()
-            home_motor(client)
-            return
+    if current_direction == 'up' and hall_effect_sensor.is_active:
+        print("End-stop reached. Motor will not run up.")
+        return
 
-        # Check for end-stop if moving up
-        if current_direction == 'up' and hall_effect_sensor.is_active:
-            print("End-stop reached. Cannot move further up.")
-            break
+    # Closed-loop move along a trapezoidal velocity profile
+    result = motion.move_to(target_cm, should_stop)
 
-        time.sleep(0.05)  # Short delay to avoid excessive CPU usage
+    if result == winchMotion.STALLED:
+        print("Encoder is not registering changes. Stopping motor and rehoming.")
+        home_motor(client, should_stop)
+        return
+    if result == winchMotion.CANCELLED:
+        print(f"Move cancelled at {get_position_cm()} cm by a new command.")
+        return
+    if result == winchMotion.ENDSTOP:
+        print("End-stop reached. Cannot move further up.")
+    elif result == winchMotion.TIMEOUT:
+        print("Move timed out before reaching the target.")
 
-    # Stop the motor after reaching the target or if end-stop is triggered
-    pwm_motor.off()
+    # The motor is stopped when the move ends
     final_position = get_position_cm()
-    print(f"Reached position: {final_position} cm at {position_pulses} pulses")
+    print(f"Reached position: {final_position} cm at {encoder.pulses()} pulses")
     client.publish(status_topic, (final_position / 100))
 
 
+def execute_command(client, command, should_stop):
+    """Runs one winch command on the motion worker thread."""
+    global winch_state, target_cm
+    try:
+        if command == HOME:
+            winch_state, target_cm = 'homing', 0.0
+            home_motor(client, should_stop)
+            return
+
+        _, target_position = command
+        if not homed:
+            # Position is unknown until the winch has been homed once (e.g. startup homing was cancelled)
+            winch_state, target_cm = 'homing', 0.0
+            if not home_motor(client, should_stop):
+                return
+        winch_state, target_cm = 'moving', target_position
+        move_to_position(client, target_position, should_stop)
+    finally:
+        winch_state = 'idle'
+
+def state_message():
+    """Compact JSON snapshot of the winch for platform/winchState."""
+    return json.dumps({
+        "t": round(time.time(), 2),
+        "state": winch_state,
+        "pos": round(get_position_cm(), 2),
+        "vel": round(get_velocity_cm_s(), 2),
+        "dir": current_direction if motor_duty else "stop",
+        "target": target_cm,
+        "duty": round(motor_duty, 3),
+        "endstop": int(hall_effect_sensor.is_active),
+        "homed": homed,
+    }, separators=(',', ':'))
+
+def stream_state(client, stop_event):
+    """Publishes platform/winchState at STATE_RATE_HZ while moving and every STATE_IDLE_INTERVAL s at rest."""
+    last_publish = 0
+    while not stop_event.is_set():
+        interval = STATE_IDLE_INTERVAL if winch_state == 'idle' else 1.0 / STATE_RATE_HZ
+        now = time.monotonic()
+        if now - last_publish >= interval:
+            client.publish(state_topic, state_message())
+            last_publish = now
+        stop_event.wait(1.0 / STATE_RATE_HZ)
+
 def on_mqtt_message(client, userdata, message):
-    """Callback function to handle MQTT messages."""
+    """Callback function to handle MQTT messages. Only hands the setpoint to the motion worker."""
     try:
         target_position = float(message.payload.decode())
         print(f"Received target position: {target_position} cm from MQTT")
         
         if target_position == 0:
-            home_motor(client)  # Home the motor if the setpoint is 0
+            worker.submit(HOME)  # Home the motor if the setpoint is 0
         else:
-            move_to_position(client, target_position)
+            worker.submit(("move", target_position))
     except ValueError:
         print("Invalid MQTT message: expected numeric target position")
 
@@ -182,9 +311,11 @@ def on_mqtt_disconnect(client, userdata, rc):
     
     # If unable to reconnect after initial connection, home the motor
     print("Failed to reconnect after multiple attempts. Homing the motor.")
-    home_motor(client)
+    worker.submit(HOME)
 
 def main():
+    global worker
+
     # Set up MQTT client
     client = mqtt.Client()
     client.on_message = on_mqtt_message
@@ -203,19 +334,31 @@ def main():
         print("Failed to connect after multiple attempts. Exiting program.")
         return
 
+    # Winch commands run on their own thread so MQTT keeps being served while the winch moves
+    worker = MotionWorker(lambda command, should_stop: execute_command(client, command, should_stop))
+    worker.start()
+
     # Subscribe to the setpoint topic and start the MQTT loop
     client.subscribe(mqtt_topic)
     client.loop_start()
 
+    # Stream the winch state from its own thread, the control loop does no printing or publishing
+    stop_streaming = threading.Event()
+    threading.Thread(target=stream_state, args=(client, stop_streaming), daemon=True).start()
+
     try:
-        home_motor(client)  # Initial homing at startup
+        worker.submit(HOME)  # Initial homing at startup
         while True:
             time.sleep(1)  # Keep the program running to receive MQTT messages
     except KeyboardInterrupt:
         print("Exiting program.")
     finally:
+        stop_streaming.set()
+        worker.stop()
+        worker.join(timeout=2)
         client.loop_stop()
         pwm_motor.close()
+        encoder.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,163 @@
+#
+# Position sensing for the winch encoder using pigpio's hardware-timestamped edge callbacks.
+#
+# With both encoder channels wired the edges are decoded as quadrature (4 counts per pulse)
+# and the direction comes from the encoder itself. With only channel A wired, rising edges of A
+# are counted and the direction is taken from the motor direction, like before.
+#
+# pigpiod samples the pins itself and timestamps every edge in microseconds, so no edges are lost
+# when Python is busy. The glitch filter replaces gpiozero's 5 ms bounce time, which dropped pulses
+# at higher motor speeds.
+#
+
+import threading
+import pigpio
+
+TICK_MASK = 0xFFFFFFFF  # pigpio ticks are microseconds since boot and wrap around every ~72 minutes
+
+# Quadrature transitions: index (previous AB state << 2) | new AB state -> count change.
+# Transitions where both channels changed at once are invalid and count 0 (and as an error).
+QUADRATURE_TABLE = (
+     0, +1, -1,  0,
+    -1,  0,  0, +1,
+    +1,  0,  0, -1,
+     0, -1, +1,  0,
+)
+INVALID_TRANSITIONS = {0b0011, 0b0110, 0b1001, 0b1100}
+
+def tick_diff(start, end):
+    """Microseconds from start to end, correct across tick wrap-around."""
+    return (end - start) & TICK_MASK
+
+class QuadratureEncoder:
+    """
+    Counts encoder edges and keeps the last buffer_size (tick, count) pairs in a fixed-size ring buffer
+    for velocity estimation. Positions are in cm, velocities in cm/s, positive is down (cable out).
+    """
+
+    def __init__(self, pi, pin_a, pin_b=None, distance_per_pulse=1.0, direction_source=None,
+                 invert=False, glitch_us=100, pull=pigpio.PUD_OFF, buffer_size=64, velocity_window_us=200000):
+        self.pi = pi
+        self.pin_a = pin_a
+        self.pin_b = pin_b
+        self.quadrature = pin_b is not None
+        self.edges_per_pulse = 4 if self.quadrature else 1
+        self.distance_per_count = distance_per_pulse / self.edges_per_pulse
+        self.direction_source = direction_source  # Callable returning +1 (down) or -1 (up), single channel only
+        self.sign = -1 if invert else 1
+        self.velocity_window_us = velocity_window_us
+
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0  # Invalid quadrature transitions (missed edges)
+        self.buffer_size = buffer_size
+        self.ticks = [0] * buffer_size
+        self.counts = [0] * buffer_size
+        self.head = 0    # Next slot to write
+        self.filled = 0  # Number of valid entries
+
+        self.callbacks = []
+        for pin in (pin_a, pin_b):
+            if pin is None:
+                continue
+            pi.set_mode(pin, pigpio.INPUT)
+            pi.set_pull_up_down(pin, pull)
+            pi.set_glitch_filter(pin, glitch_us)
+
+        if self.quadrature:
+            self.state = (pi.read(pin_a) << 1) | pi.read(pin_b)
+            self.callbacks.append(pi.callback(pin_a, pigpio.EITHER_EDGE, self.on_quadrature_edge))
+            self.callbacks.append(pi.callback(pin_b, pigpio.EITHER_EDGE, self.on_quadrature_edge))
+        else:
+            self.callbacks.append(pi.callback(pin_a, pigpio.RISING_EDGE, self.on_pulse))
+
+    def on_quadrature_edge(self, gpio, level, tick):
+        if level > 1:
+            return  # Watchdog timeout, not an edge
+        if gpio == self.pin_a:
+            new_state = (level << 1) | (self.state & 1)
+        else:
+            new_state = (self.state & 2) | level
+        transition = (self.state << 2) | new_state
+        self.state = new_state
+        if transition in INVALID_TRANSITIONS:
+            self.errors += 1
+            return
+        step = QUADRATURE_TABLE[transition]
+        if step:
+            self.record(step * self.sign, tick)
+
+    def on_pulse(self, gpio, level, tick):
+        direction = self.direction_source() if self.direction_source else 1
+        self.record(direction, tick)
+
+    def record(self, step, tick):
+        with self.lock:
+            self.count += step
+            self.ticks[self.head] = tick
+            self.counts[self.head] = self.count
+            self.head = (self.head + 1) % self.buffer_size
+            if self.filled < self.buffer_size:
+                self.filled += 1
+
+    def position(self):
+        """Current position in cm."""
+        return self.count * self.distance_per_count
+
+    def pulses(self):
+        """Current position in encoder pulses (channel A periods)."""
+        return self.count / self.edges_per_pulse
+
+    def reset(self, position_cm=0.0):
+        """Sets the current position, e.g. to 0 when the home sensor trips."""
+        with self.lock:
+            self.count = int(round(position_cm / self.distance_per_count))
+            self.filled = 0
+
+    def last_edge_age(self):
+        """Microseconds since the last counted edge, None if there has been none since the last reset."""
+        with self.lock:
+            if not self.filled:
+                return None
+            last_tick = self.ticks[(self.head - 1) % self.buffer_size]
+        return tick_diff(last_tick, self.pi.get_current_tick())
+
+    def velocity(self):
+        """
+        Velocity in cm/s from the edges of the last velocity_window_us.
+        Once no edges arrive the estimate decays as if the next edge was about to come, down to 0.
+        """
+        now = self.pi.get_current_tick()
+        with self.lock:
+            if self.filled < 2:
+                return 0.0
+            newest = (self.head - 1) % self.buffer_size
+            newest_tick = self.ticks[newest]
+            newest_count = self.counts[newest]
+
+            # Walk back to the oldest edge inside the window
+            oldest = newest
+            for _ in range(self.filled - 1):
+                previous = (oldest - 1) % self.buffer_size
+                if tick_diff(self.ticks[previous], newest_tick) > self.velocity_window_us:
+                    break
+                oldest = previous
+            if oldest == newest:
+                oldest = (newest - 1) % self.buffer_size
+            elapsed = tick_diff(self.ticks[oldest], newest_tick)
+            counts = newest_count - self.counts[oldest]
+
+        if elapsed == 0:
+            return 0.0
+        since_last = tick_diff(newest_tick, now)
+        if since_last > self.velocity_window_us:
+            return 0.0  # Stopped
+        # While waiting for the next edge the speed can be at most one count per time since the last edge
+        per_count = max(elapsed / max(abs(counts), 1), since_last)
+        direction = 1 if counts > 0 else -1 if counts < 0 else 0
+        return direction * self.distance_per_count / (per_count / 1e6)
+
+    def close(self):
+        for callback in self.callbacks:
+            callback.cancel()
+        self.callbacks = []
@@ -0,0 +1,245 @@
+#
+# Closed-loop motion control for the winch.
+#
+# A move follows a trapezoidal velocity profile (accelerate, cruise, decelerate) from the current
+# position to the target. At a fixed control rate the motor duty is set from a velocity feedforward
+# plus a PID correction on the difference between the profile position and the encoder position,
+# so the winch can run fast and still stop at the target without overshooting.
+#
+# Nothing in here touches the hardware, winchController passes in functions to read the position
+# and drive the motor. Positions are in cm, positive is down (cable out). Duty is -1.0 to 1.0.
+#
+
+import math
+import threading
+import time
+
+# Results of MotionController.move_to()
+REACHED = "reached"
+STALLED = "stalled"      # Motor driven but the encoder did not move
+ENDSTOP = "endstop"      # End-stop reached while moving up
+TIMEOUT = "timeout"      # Move took much longer than the profile
+CANCELLED = "cancelled"  # should_stop() returned True
+
+class TrapezoidalProfile:
+    """Position/velocity reference for a move from rest at start to rest at target."""
+
+    def __init__(self, start, target, max_velocity, max_acceleration):
+        self.start = start
+        self.target = target
+        self.direction = 1 if target >= start else -1
+        distance = abs(target - start)
+
+        # Triangular profile if there is no room to reach max_velocity
+        accel_distance = max_velocity ** 2 / (2 * max_acceleration)
+        if 2 * accel_distance > distance:
+            self.peak_velocity = math.sqrt(distance * max_acceleration)
+            accel_distance = distance / 2
+        else:
+            self.peak_velocity = max_velocity
+        self.acceleration = max_acceleration
+        self.accel_time = self.peak_velocity / max_acceleration
+        self.cruise_time = (distance - 2 * accel_distance) / self.peak_velocity if self.peak_velocity else 0.0
+        self.accel_distance = accel_distance
+        self.duration = 2 * self.accel_time + self.cruise_time
+
+    def sample(self, t):
+        """Returns (position, velocity) of the reference at t seconds into the move."""
+        if t <= 0:
+            return self.start, 0.0
+        if t >= self.duration:
+            return self.target, 0.0
+
+        if t < self.accel_time:
+            travelled = 0.5 * self.acceleration * t ** 2
+            velocity = self.acceleration * t
+        elif t < self.accel_time + self.cruise_time:
+            travelled = self.accel_distance + self.peak_velocity * (t - self.accel_time)
+            velocity = self.peak_velocity
+        else:
+            remaining = self.duration - t
+            travelled = 2 * self.accel_distance + self.peak_velocity * self.cruise_time \
+                - 0.5 * self.acceleration * remaining ** 2
+            velocity = self.acceleration * remaining
+        return self.start + self.direction * travelled, self.direction * velocity
+
+class PID:
+    """PID controller with a clamped integral (anti-windup)."""
+
+    def __init__(self, kp, ki=0.0, kd=0.0, integral_limit=1.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.integral_limit = integral_limit
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.previous_error = None
+
+    def update(self, error, dt):
+        if self.ki:
+            self.integral += error * dt
+            limit = self.integral_limit / self.ki
+            self.integral = max(-limit, min(limit, self.integral))
+        derivative = 0.0
+        if self.previous_error is not None and dt > 0:
+            derivative = (error - self.previous_error) / dt
+        self.previous_error = error
+        return self.kp * error + self.ki * self.integral + self.kd * derivative
+
+class MotionController:
+    """
+    Runs moves at a fixed control rate.
+      get_position()   - current position in cm
+      set_output(duty) - drive the motor, positive duty moves down, 0 stops
+      at_endstop()     - True when the home end-stop is active
+    """
+
+    def __init__(self, get_position, set_output, at_endstop=lambda: False,
+                 max_velocity=20.0, max_acceleration=10.0, velocity_per_duty=40.0,
+                 kp=0.02, ki=0.0, kd=0.0, max_duty=1.0, min_duty=0.0,
+                 control_rate_hz=50, tolerance=1.0, settle_time=0.2,
+                 stall_timeout=0.5, stall_duty=0.15, timeout_margin=10.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.get_position = get_position
+        self.set_output = set_output
+        self.at_endstop = at_endstop
+        self.max_velocity = max_velocity          # cm/s
+        self.max_acceleration = max_acceleration  # cm/s^2
+        self.velocity_per_duty = velocity_per_duty  # cm/s at duty 1.0, for the feedforward
+        self.pid = PID(kp, ki, kd)
+        self.max_duty = max_duty
+        self.min_duty = min_duty    # Smallest duty that still turns the motor
+        self.period = 1.0 / control_rate_hz
+        self.tolerance = tolerance  # cm
+        self.settle_time = settle_time
+        self.stall_timeout = stall_timeout
+        self.stall_duty = stall_duty  # Only duties at least this large are expected to move the winch
+        self.timeout_margin = timeout_margin  # Seconds allowed beyond the profile duration
+        self.clock = clock
+        self.sleep = sleep
+
+        self.target = None
+        self.reference = None  # (position, velocity) the controller is currently following
+        self.duty = 0.0
+
+    def compute_duty(self, position, reference_position, reference_velocity):
+        error = reference_position - position
+        duty = reference_velocity / self.velocity_per_duty + self.pid.update(error, self.period)
+        duty = max(-self.max_duty, min(self.max_duty, duty))
+        if abs(error) > self.tolerance and 0 < abs(duty) < self.min_duty:
+            duty = math.copysign(self.min_duty, duty)
+        return duty
+
+    def move_to(self, target, should_stop=None):
+        """Moves to target (cm) and returns one of REACHED, STALLED, ENDSTOP, TIMEOUT, CANCELLED."""
+        start_position = self.get_position()
+        profile = TrapezoidalProfile(start_position, target, self.max_velocity, self.max_acceleration)
+        self.target = target
+        self.pid.reset()
+
+        start = self.clock()
+        next_tick = start
+        settled_since = None
+        last_position = start_position
+        last_motion = start
+
+        try:
+            while True:
+                now = self.clock()
+                elapsed = now - start
+                position = self.get_position()
+
+                if should_stop is not None and should_stop():
+                    return CANCELLED
+
+                reference_position, reference_velocity = profile.sample(elapsed)
+                self.reference = (reference_position, reference_velocity)
+                duty = self.compute_duty(position, reference_position, reference_velocity)
+
+                if duty < 0 and self.at_endstop():
+                    return ENDSTOP
+
+                # Finished when the profile is done and the position stayed within tolerance
+                if elapsed >= profile.duration and abs(target - position) <= self.tolerance:
+                    if settled_since is None:
+                        settled_since = now
+                    if now - settled_since >= self.settle_time:
+                        return REACHED
+                    duty = 0.0
+                else:
+                    settled_since = None
+
+                # Stall detection: the motor is driven but the encoder does not move
+                if position != last_position or abs(duty) < self.stall_duty:
+                    last_position = position
+                    last_motion = now
+                elif now - last_motion > self.stall_timeout:
+                    return STALLED
+
+                if elapsed > profile.duration + self.timeout_margin:
+                    return TIMEOUT
+
+                self.duty = duty
+                self.set_output(duty)
+
+                next_tick += self.period
+                self.sleep(max(0.0, next_tick - self.clock()))
+        finally:
+            self.duty = 0.0
+            self.set_output(0.0)
+            self.reference = None
+
+class MotionWorker(threading.Thread):
+    """
+    Runs winch commands on its own thread, one at a time, so the MQTT thread only has to submit them.
+    There is a single command slot: a newer command replaces one that is still waiting and cancels the
+    one that is running (the running move sees should_stop() return True within one control period).
+    Submitting the command that is already running is ignored, so repeated setpoints do not restart a move.
+
+    execute(command, should_stop) is called for every command and must return when should_stop() is True.
+    """
+
+    def __init__(self, execute):
+        super().__init__(daemon=True)
+        self.execute = execute
+        self.condition = threading.Condition()
+        self.pending = None
+        self.current = None
+        self.cancel_event = threading.Event()
+        self.running = True
+
+    def submit(self, command):
+        with self.condition:
+            if command == self.current and self.pending is None:
+                return
+            self.pending = command
+            if self.current is not None:
+                self.cancel_event.set()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending = None
+            self.cancel_event.set()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                command = self.current = self.pending
+                self.pending = None
+                self.cancel_event.clear()
+            try:
+                self.execute(command, self.cancel_event.is_set)
+            except Exception as e:
+                print(f"Error executing winch command {command}: {e}")
+            finally:
+                with self.condition:
+                    self.current = None